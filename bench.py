@@ -0,0 +1,535 @@
+"""
+Benchmarks for the workshop app, to catch performance regressions before a live session.
+
+    python bench.py codec --users 80
+    python bench.py startup
+    python bench.py workshop --students 80 --minutes 30
+    python bench.py batch --submissions 40
+    python bench.py stress --students 80
+    python bench.py merge --users 80
+"""
+
+import argparse
+import heapq
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+from collections import defaultdict
+from dataclasses import asdict, fields, is_dataclass
+from pathlib import Path
+from time import perf_counter, process_time
+from typing import Any, Callable
+
+from streamlit.testing.v1 import AppTest
+
+import main
+from fake_openai import FakeOpenAI
+
+
+def timeit(fn, repeat: int = 5) -> float:
+    """Best time of `repeat` runs, in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        best = min(best, perf_counter() - start)
+    return best * 1000
+
+
+def fake_workshop(n_users: int, seed: int = 0) -> main.DataBase:
+    """A database where every participant answered about two thirds of the questions."""
+    rng = random.Random(seed)
+    database = main.DataBase()
+    for i in range(n_users):
+        database.login(f"participant-{i}", "")
+
+    t = 1_700_000_000.0
+    for user in database.users.values():
+        for q in user.all_questions():
+            if rng.random() < 0.3:
+                continue
+            for _ in range(rng.randint(1, 3)):
+                t += rng.uniform(1, 30)
+                database.add_message(q, main.Message(user.name, "lorem ipsum " * 20, t))
+                t += rng.uniform(1, 300)
+                database.add_message(q, main.Message(main.TEACHER_NAME, "dolor sit " * 15, t))
+    return database
+
+
+# The conversion functions before the codec, as a reference.
+def legacy_dataclass_to_dict(obj: Any) -> Any:
+    if is_dataclass(obj):
+        return {k: legacy_dataclass_to_dict(v) for k, v in asdict(obj).items()}
+    elif isinstance(obj, list):
+        return [legacy_dataclass_to_dict(i) for i in obj]
+    elif isinstance(obj, dict):
+        return {k: legacy_dataclass_to_dict(v) for k, v in obj.items()}
+    else:
+        return obj
+
+
+def without_revisions(data: Any) -> Any:
+    """The legacy conversion, as saved now: revisions are runtime state."""
+    if isinstance(data, dict):
+        return {k: without_revisions(v) for k, v in data.items() if k != "revision"}
+    elif isinstance(data, list):
+        return [without_revisions(i) for i in data]
+    return data
+
+
+def legacy_dict_to_dataclass(cls: Any, data: Any) -> Any:
+    if isinstance(data, dict):
+        if is_dataclass(cls):
+            fieldtypes = {f.name: f.type for f in fields(cls)}
+            return cls(**{f: legacy_dict_to_dataclass(fieldtypes[f], data[f]) for f in data})
+        else:
+            return cls(**{k: legacy_dict_to_dataclass(cls.__args__[1], v) for k, v in data.items()})
+    elif isinstance(data, list):
+        return [legacy_dict_to_dataclass(cls.__args__[0], i) for i in data]
+    else:
+        return data
+
+
+def bench_codec(args):
+    # A new user, with only empty questions
+    database = main.DataBase()
+    database.login("Diego", "123")
+    assert main.DataBase.from_json(main.dataclass_to_dict(database)) == database
+
+    database = fake_workshop(args.users)
+    n_messages = sum(len(q.messages) for q in database.all_questions())
+    print(f"{args.users} users, {n_messages} messages")
+
+    data = main.dataclass_to_dict(database)
+    assert data == without_revisions(legacy_dataclass_to_dict(database))
+    assert main.dict_to_dataclass(main.DataBase, data) == database
+
+    legacy_text = json.dumps(legacy_dataclass_to_dict(database), indent=2)
+    text = json.dumps(data, separators=(",", ":"))
+    results = {
+        "encode": (
+            timeit(lambda: legacy_dataclass_to_dict(database)),
+            timeit(lambda: main.dataclass_to_dict(database)),
+        ),
+        "decode": (
+            timeit(lambda: legacy_dict_to_dataclass(main.DataBase, data)),
+            timeit(lambda: main.dict_to_dataclass(main.DataBase, data)),
+        ),
+        "save (to text)": (
+            timeit(lambda: json.dumps(legacy_dataclass_to_dict(database), indent=2)),
+            timeit(lambda: json.dumps(main.dataclass_to_dict(database), separators=(",", ":"))),
+        ),
+        "load (from text)": (
+            timeit(lambda: legacy_dict_to_dataclass(main.DataBase, json.loads(legacy_text))),
+            timeit(lambda: main.DataBase.from_json(json.loads(text))),
+        ),
+    }
+
+    print(f"{'':18} {'before':>10} {'after':>10}")
+    for name, (before, after) in results.items():
+        print(f"{name:18} {before:8.1f}ms {after:8.1f}ms  x{before / after:.1f}")
+    print(f"{'size':18} {len(legacy_text) / 1e3:8.0f}kB {len(text) / 1e3:8.0f}kB")
+
+
+# Dependencies worth deferring until their code path runs
+HEAVY_MODULES = ["streamlit", "yaml", "numpy", "pandas", "pyarrow", "altair", "openai"]
+
+
+def bench_startup(args):
+    """Import main.py in fresh processes, like a new server process does."""
+    best = float("inf")
+    for _ in range(args.repeat):
+        start = perf_counter()
+        subprocess.run([sys.executable, "-c", "import main"], check=True, capture_output=True)
+        best = min(best, perf_counter() - start)
+    print(f"python -c 'import main': {best * 1000:.0f}ms (best of {args.repeat})")
+
+    # Lines are "import time: self [us] | cumulative | imported package", indented by depth
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, time_us, name = line.removeprefix("import time:").split("|")
+        if time_us.strip().isdigit():
+            cumulative.setdefault(name.strip(), int(time_us) / 1000)
+
+    for name in HEAVY_MODULES:
+        if name in cumulative:
+            print(f"{name:10} {cumulative[name]:8.0f}ms")
+        else:
+            print(f"{name:10} {'not imported':>12}")
+
+
+class Recorder:
+    """Wall and CPU time of each page run, by kind of run and by session."""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.cpu: dict[str, float] = defaultdict(float)
+
+    def run(self, kind: str, session: str, action: Callable[[], AppTest]) -> AppTest:
+        start, start_cpu = perf_counter(), process_time()
+        at = action()
+        self.latencies[kind].append((perf_counter() - start) * 1000)
+        self.cpu[session] += process_time() - start_cpu
+        if at.exception:
+            raise RuntimeError(f"{kind} failed in {session}: {at.exception[0].message}")
+        return at
+
+    def report(self):
+        print(f"{'rerun latency':18} {'runs':>6} {'p50':>8} {'p90':>8} {'max':>8}")
+        for kind, times in self.latencies.items():
+            p50, p90 = (
+                statistics.quantiles(times, n=10, method="inclusive")[4:9:4]
+                if len(times) > 1
+                else times * 2
+            )
+            print(f"{kind:18} {len(times):6} {p50:6.0f}ms {p90:6.0f}ms {max(times):6.0f}ms")
+
+
+def bench_workshop(args):
+    """Students answer at random intervals, the teacher replies to the oldest question.
+
+    Events are ordered by a simulated clock but run back to back, so a 30 minutes workshop takes
+    as long as its page runs. Each student and the teacher has their own AppTest session, and
+    pages are rerun when they would be live: the teacher's on every new message, and a student's
+    when they get feedback.
+    """
+    rng = random.Random(args.seed)
+    llm = FakeOpenAI(delay=args.llm_delay).start()
+    workdir = Path(tempfile.mkdtemp(prefix="workshop-"))
+    shutil.copy(main.EXERCISES_PATH, workdir)
+    script = str(Path(main.__file__).resolve())
+    os.chdir(workdir)
+    os.environ.update(LIVE_UPDATES="0", OPENAI_BASE_URL=llm.base_url, OPENAI_API_KEY="fake")
+    if args.sqlite:
+        os.environ["SQLITE_PATH"] = str(workdir / "workshop.sqlite")
+
+    recorder = Recorder()
+    memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    teacher = AppTest.from_file(script, default_timeout=args.timeout)
+    teacher.session_state["username"] = main.TEACHER_NAME
+    recorder.run("teacher rerun", "teacher", teacher.run)
+
+    students: dict[str, AppTest] = {}
+    answered = defaultdict(int)
+    # (simulated time, what happens, who), the teacher replies with the key "" to sort first
+    events = [
+        (rng.expovariate(1 / args.think), "answer", f"participant-{i}")
+        for i in range(args.students)
+    ]
+    events.append((args.reply_every, "reply", ""))
+    heapq.heapify(events)
+
+    for name in [name for _, _, name in events if name]:
+        at = AppTest.from_file(script, default_timeout=args.timeout)
+        recorder.run("student login", name, at.run)
+        at.text_input[0].input(name)
+        at.text_input[1].input("")
+        students[name] = recorder.run("student login", name, at.button[0].click().run)
+
+    while events:
+        t, kind, name = heapq.heappop(events)
+        if t > args.minutes * 60:
+            break
+
+        if kind == "answer":
+            at = students[name]
+            answer = f"Answer {answered[name] + 1} of {name}, " + "lorem ipsum " * 10
+            recorder.run("student send", name, at.chat_input[-1].set_value(answer).run)
+            answered[name] += 1
+            recorder.run("teacher rerun", "teacher", teacher.run)
+            # The student waits for feedback before the next answer
+
+        elif kind == "reply":
+            heapq.heappush(events, (t + args.reply_every, "reply", ""))
+            headers = [m.value for m in teacher.markdown if m.value.startswith("## **")]
+            if not headers:
+                continue
+            # "## **participant-3** on 1 - Rephrasing  \n..."
+            student = headers[0].removeprefix("## **").partition("**")[0]
+            feedback = teacher.text_area[0].value or "Good job, maybe shorter next time."
+            teacher.text_area[0].input(feedback)
+            send = next(b for b in teacher.button if b.label == "Send")
+            recorder.run("teacher reply", "teacher", send.click().run)
+            recorder.run("student update", student, students[student].run)
+            if answered[student] < main.NUM_QUESTIONS:
+                heapq.heappush(events, (t + rng.expovariate(1 / args.think), "answer", student))
+
+    memory_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    messages = sum(answered.values())
+    print(f"{args.students} students, {messages} answers in {args.minutes} simulated minutes")
+    print(f"{llm.requests} requests to the fake LLM")
+    recorder.report()
+
+    student_cpu = [recorder.cpu[name] for name in students]
+    print(f"CPU per student session: {statistics.mean(student_cpu) * 1000:.0f}ms mean, ", end="")
+    print(f"{max(student_cpu) * 1000:.0f}ms max. Teacher: {recorder.cpu['teacher'] * 1000:.0f}ms")
+    print(f"Peak memory growth: {(memory_after - memory_before) / 1024:.0f}MB")
+
+    # The cost of saving the final state, loaded again by a fresh storage
+    if args.sqlite:
+        storage = main.SqliteStorage(Path(os.environ["SQLITE_PATH"]), workdir / "backups")
+    else:
+        storage = main.Journal(workdir / "backups")
+    database = storage.load()
+    snapshot = timeit(lambda: storage.snapshot(database), repeat=3)
+    question = next(q for q in database.all_questions() if q.messages)
+    message = timeit(lambda: database.add_message(question, main.Message("bench", "ipsum")), 20)
+    print(f"Save: {snapshot:.1f}ms for the whole database, {message:.2f}ms per message")
+    shutil.rmtree(workdir)
+
+
+def bench_batch(args):
+    """Drafts for a round of first answers to one variation: one request each, or batched."""
+    import openai
+
+    llm = FakeOpenAI(delay=args.llm_delay).start()
+    workdir = Path(tempfile.mkdtemp(prefix="batch-"))
+    questions = [
+        main.Question(f"p{i}", 0, 0, [main.Message(f"p{i}", f"Answer {i}, " + "lorem " * 30)])
+        for i in range(args.submissions)
+    ]
+
+    print(f"{args.submissions} submissions to the same variation")
+    print(f"{'':12} {'requests':>9} {'tokens':>8} {'time':>8}")
+    for name, window in [("one by one", 0), ("batched", 0.1)]:
+        metrics = main.Metrics()
+        client = openai.OpenAI(base_url=llm.base_url, api_key="fake", max_retries=0)
+        scheduler = main.LLMScheduler(client, metrics=metrics)
+        cache = main.FeedbackCache(workdir / f"{name}.sqlite")
+        drafts = main.FeedbackDrafts(scheduler, cache, main.EXERCISES, on_ready=lambda: None)
+        drafts.batch_window = window
+
+        requests = llm.requests
+        start = perf_counter()
+        futures = [drafts.request(q) for q in questions]
+        assert all(f is not None and f.result() for f in futures)
+        elapsed = perf_counter() - start
+        tokens = sum(v for (metric, _), v in metrics.counters.items() if metric.endswith("tokens"))
+        print(f"{name:12} {llm.requests - requests:9} {tokens:8.0f} {elapsed:7.1f}s")
+    shutil.rmtree(workdir)
+
+
+def bench_stress(args):
+    """Students, teachers and readers change and read one database from many threads at once.
+
+    Like streamlit sessions, each has its own thread. Students log in and answer, teachers reply
+    to or skip the questions in the queue, and readers export the database and list the queue
+    meanwhile. At the end, every message must be there exactly once, and the storage must load
+    the same database back.
+    """
+    workdir = Path(tempfile.mkdtemp(prefix="stress-"))
+    (workdir / "backups").mkdir()
+    if args.sqlite:
+        storage = main.SqliteStorage(workdir / "workshop.sqlite", workdir / "backups")
+    else:
+        storage = main.Journal(workdir / "backups")
+    database = storage.load()
+
+    errors: list[str] = []
+    counts = defaultdict(int)
+    lock = threading.Lock()
+    students_done = threading.Event()
+
+    def thread(fn: Callable[[int], int], kind: str, i: int) -> threading.Thread:
+        def run():
+            try:
+                n = fn(i)
+            except Exception:
+                errors.append(traceback.format_exc())
+                return
+            with lock:
+                counts[kind] += n
+
+        return threading.Thread(target=run, name=f"{kind}-{i}")
+
+    def student(i: int) -> int:
+        name = f"participant-{i}"
+        database.login(name, "")
+        questions = database.users[name].all_questions()[: args.answers]
+        for n, q in enumerate(questions):
+            database.add_message(q, main.Message(name, f"Answer {n} of {name}"))
+        return len(questions)
+
+    def teacher(i: int) -> int:
+        rng = random.Random(i)
+        sent = 0
+        while not students_done.is_set() or database.questions_needing_feedback():
+            for q in database.questions_needing_feedback()[:5]:
+                if rng.random() < 0.2:
+                    database.skip(q)
+                else:
+                    database.add_message(q, main.Message(main.TEACHER_NAME, f"Feedback {i}"))
+                    sent += 1
+        return sent
+
+    def reader(i: int) -> int:
+        reads = 0
+        while not students_done.is_set():
+            json.dumps(database.to_json())
+            database.progress()
+            database.answer_time_stats.bins()
+            for q in database.questions_needing_feedback():
+                q.fmt_messages(main.TEACHER_NAME)
+            reads += 1
+        return reads
+
+    students = [thread(student, "answers", i) for i in range(args.students)]
+    others = [thread(teacher, "feedback", i) for i in range(args.teachers)]
+    others += [thread(reader, "reads", i) for i in range(args.readers)]
+    start = perf_counter()
+    for t in students + others:
+        t.start()
+    for t in students:
+        t.join()
+    students_done.set()
+    for t in others:
+        t.join()
+    elapsed = perf_counter() - start
+
+    messages = sum(len(q.messages) for q in database.all_questions())
+    print(f"{args.students} students, {args.teachers} teachers, {args.readers} readers")
+    print(f"{counts['answers']} answers and {counts['feedback']} feedback in {elapsed:.1f}s")
+    print(f"{counts['reads']} full reads, {counts['reads'] / elapsed:.0f} per second")
+    for error in errors:
+        print(error)
+    assert not errors, f"{len(errors)} threads failed"
+    assert messages == counts["answers"] + counts["feedback"], f"{messages} messages stored"
+    assert not database.questions_needing_feedback()
+
+    if args.sqlite:
+        storage.close()
+        storage = main.SqliteStorage(workdir / "workshop.sqlite", workdir / "backups")
+    else:
+        storage = main.Journal(workdir / "backups")
+    assert storage.load() == database, "The storage loads a different database"
+    storage.close()
+    print("Every message is there once, and the storage loads the same database")
+    shutil.rmtree(workdir)
+
+
+def bench_merge(args):
+    """Merge a backup into the database that was wiped after it, and check what it added.
+
+    After the wipe, most participants logged in again, so their questions have new uids and
+    are found by user, exercise and variation. Some of their messages were sent again with the
+    same timestamp, and the teacher answered some questions at the same second as a message of
+    the backup. Each message must be there once, in order, and merging again must add nothing.
+    """
+    rng = random.Random(args.seed)
+    backup = fake_workshop(args.users, args.seed)
+    database = main.DataBase()
+    later = max(m.timestamp for q in backup.all_questions() for m in q.messages)
+    for user in backup.users.values():
+        if rng.random() < 0.1:
+            continue  # Never came back, the merge adds the whole user
+        database.login(user.name, "")
+        for old, q in zip(user.all_questions(), database.users[user.name].all_questions()):
+            new = [m for m in old.messages if rng.random() < 0.3]
+            if old.messages and rng.random() < 0.2:
+                new.append(main.Message(main.TEACHER_NAME, "Same time", old.messages[0].timestamp))
+            if rng.random() < 0.3:
+                later += 1
+                new.append(main.Message(user.name, "After the wipe", later))
+            for m in sorted(new, key=lambda m: m.timestamp):
+                database.add_message(q, m)
+
+    def messages(db: main.DataBase) -> dict[tuple[str, int, int], list[tuple[str, float]]]:
+        return {
+            (q.user, q.exo, q.variation): [(m.user, m.timestamp) for m in q.messages]
+            for q in db.all_questions()
+        }
+
+    expected = defaultdict(set)
+    for db in (backup, database):
+        for key, keys in messages(db).items():
+            expected[key].update(keys)
+    in_both = sum(
+        len(set(keys) & set(messages(database).get(key, ())))
+        for key, keys in messages(backup).items()
+    )
+
+    diff_time = timeit(lambda: database.diff(backup))
+    start = perf_counter()
+    diff = database.merge(backup)
+    merge_time = (perf_counter() - start) * 1000
+    print(f"{args.users} users, {sum(map(len, expected.values()))} messages once merged")
+    print(f"diff {diff_time:.1f}ms, merge {merge_time:.1f}ms")
+    print(f"Added {diff.summary()}")
+
+    merged = messages(database)
+    assert diff.known == in_both, f"{diff.known} messages known, {in_both} in both"
+    assert merged.keys() == expected.keys(), "Some questions are missing"
+    for key, keys in merged.items():
+        assert len(keys) == len(set(keys)), f"Duplicated messages on {key}"
+        assert set(keys) == expected[key], f"Missing messages on {key}"
+        timestamps = [t for _, t in keys]
+        assert timestamps == sorted(timestamps), f"Messages out of order on {key}"
+
+    before = main.DataBase.from_json(database.to_json())
+    revision = database.revision
+    again = database.merge(backup)
+    assert not again.users and not again.messages, f"Merging again added {again.summary()}"
+    assert database == before and database.revision == revision, "Merging again changed it"
+    print("Every message is there once and in order, and merging again adds nothing")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(required=True)
+
+    codec = subparsers.add_parser("codec", help="Round-trip of the database to JSON")
+    codec.add_argument("--users", type=int, default=80)
+    codec.set_defaults(func=bench_codec)
+
+    startup = subparsers.add_parser("startup", help="Import time of main.py in a new process")
+    startup.add_argument("--repeat", type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    workshop = subparsers.add_parser("workshop", help="Simulated workshop through AppTest")
+    workshop.add_argument("--students", type=int, default=20)
+    workshop.add_argument("--minutes", type=float, default=20, help="Simulated duration")
+    workshop.add_argument("--think", type=float, default=90, help="Mean seconds per answer")
+    workshop.add_argument("--reply-every", type=float, default=15, help="Seconds per feedback")
+    workshop.add_argument("--llm-delay", type=float, default=0.5, help="Seconds per LLM answer")
+    workshop.add_argument("--timeout", type=float, default=30, help="Seconds per page run")
+    workshop.add_argument("--sqlite", action="store_true", help="Store the database in SQLite")
+    workshop.add_argument("--seed", type=int, default=0)
+    workshop.set_defaults(func=bench_workshop)
+
+    batch = subparsers.add_parser("batch", help="Batched LLM drafts against one request each")
+    batch.add_argument("--submissions", type=int, default=40)
+    batch.add_argument("--llm-delay", type=float, default=1, help="Seconds per LLM answer")
+    batch.set_defaults(func=bench_batch)
+
+    stress = subparsers.add_parser("stress", help="Concurrent changes to one database")
+    stress.add_argument("--students", type=int, default=80)
+    stress.add_argument("--teachers", type=int, default=2)
+    stress.add_argument("--readers", type=int, default=4)
+    stress.add_argument("--answers", type=int, default=10, help="Answers per student")
+    stress.add_argument("--sqlite", action="store_true", help="Store the database in SQLite")
+    stress.set_defaults(func=bench_stress)
+
+    merge = subparsers.add_parser("merge", help="Merge of a backup into a wiped database")
+    merge.add_argument("--users", type=int, default=80)
+    merge.add_argument("--seed", type=int, default=0)
+    merge.set_defaults(func=bench_merge)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,39 @@
+"""
+Export the messages of a workshop as CSV, one row per message, for analysis.
+
+    python export.py > transcripts.csv
+    python export.py --workshop spring --latest -o spring.csv
+
+All the backups are read, one at a time, so that messages from before a wipe or a backup load
+are exported too. Each message is written once, from the most recent backup that has it.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import main
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workshop", default="", help="Name of the workshop, default if empty")
+    parser.add_argument("--latest", action="store_true", help="Only the latest state")
+    parser.add_argument("-o", "--output", type=Path, help="CSV file, standard output if not set")
+    args = parser.parse_args()
+
+    files = main.workshop_files(args.workshop)
+    if files is None:
+        sys.exit(f"There is no workshop named {args.workshop!r} in {main.WORKSHOPS_DIR}")
+    exercises = main.load_catalogue(str(files.exercises), files.exercises.stat().st_mtime)
+    journal = main.Journal(files.backups)
+    states = journal.states()
+    if args.latest:
+        states = [next(states, main.DataBase())]
+
+    if args.output:
+        with args.output.open("w", newline="") as out:
+            rows = main.write_transcripts(states, exercises.exercises, out)
+    else:
+        rows = main.write_transcripts(states, exercises.exercises, sys.stdout)
+    print(f"Exported {rows} messages", file=sys.stderr)
@@ -0,0 +1,156 @@
+"""
+A local stand-in for the OpenAI chat completions API, to develop and load-test without an API key.
+
+    python fake_openai.py --port 8765 --delay 2
+    OPENAI_BASE_URL=http://localhost:8765/v1 OPENAI_API_KEY=fake make run
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self, port: int = 0, delay: float = 0.0, token_delay: float = 0.0, error_rate: float = 0.0
+    ):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.delay = delay
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.requests = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/v1"
+
+    def start(self) -> "FakeOpenAI":
+        """Serve in a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def fake_feedback(messages: list[dict], json_object: bool = False) -> str:
+    last = messages[-1]["content"] if messages else ""
+    if json_object:
+        # A batch of numbered responses, see main.batch_feedback_prompt
+        responses = re.findall(r"^\[\d+\] (.*)$", last, flags=re.MULTILINE)
+        return json.dumps({"feedback": [fake_feedback_on(r) for r in responses]})
+    return fake_feedback_on(last.rpartition("Response: ")[2])
+
+
+def fake_feedback_on(response: str) -> str:
+    return f"Fake feedback on {response[:60]!r}: good job, try to be more concise."
+
+
+class Handler(BaseHTTPRequestHandler):
+    server: FakeOpenAI
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests += 1
+        if random.random() < self.server.error_rate:
+            error = {"message": "Rate limit reached (fake)", "type": "requests", "code": None}
+            self.send_json({"error": error}, status=429)
+            return
+        sleep(self.server.delay)
+
+        json_object = (body.get("response_format") or {}).get("type") == "json_object"
+        content = fake_feedback(body["messages"], json_object)
+        usage = {
+            "prompt_tokens": sum(len(m["content"]) // 4 for m in body["messages"]),
+            "completion_tokens": len(content) // 4,
+            "total_tokens": 0,
+        }
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            self.send_stream(body["model"], content, usage if include_usage else None)
+            return
+
+        sleep(self.server.token_delay * len(content.split()))
+        self.send_json(
+            {
+                "id": f"chatcmpl-fake-{self.server.requests}",
+                "object": "chat.completion",
+                "created": int(time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            }
+        )
+
+    def send_stream(self, model: str, content: str, usage: dict | None = None):
+        """Send the content word by word, as server-sent events, then the usage if given."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            chunk = {
+                "id": f"chatcmpl-fake-{self.server.requests}",
+                "object": "chat.completion.chunk",
+                "created": int(time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": word if i == 0 else " " + word},
+                        "finish_reason": "stop" if i == len(words) - 1 else None,
+                    }
+                ],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            sleep(self.server.token_delay)
+        if usage is not None:
+            chunk = {
+                "id": f"chatcmpl-fake-{self.server.requests}",
+                "object": "chat.completion.chunk",
+                "created": int(time()),
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def send_json(self, data: dict, status: int = 200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=1.0, help="Seconds before each answer")
+    parser.add_argument("--token-delay", type=float, default=0.05, help="Seconds per word")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 429 errors")
+    args = parser.parse_args()
+
+    server = FakeOpenAI(args.port, args.delay, args.token_delay, args.error_rate)
+    print(f"Fake OpenAI API on {server.base_url}")
+    server.serve_forever()
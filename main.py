@@ -1,22 +1,50 @@
+import abc
+import bisect
+import csv
 import dataclasses
+import gzip
+import hashlib
+import heapq
+import io
 import json
+import math
 import os
+import random
+import sqlite3
+import threading
 import traceback
 import uuid
-from copy import deepcopy
-from dataclasses import asdict, dataclass, field, fields, is_dataclass
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields, is_dataclass
 from datetime import datetime
+from functools import cached_property
 from pathlib import Path
-from time import sleep, time
-from typing import Any, Self, Type, TypeVar
+from time import perf_counter, sleep, time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    Self,
+    TextIO,
+    Type,
+    TypeVar,
+    get_args,
+    get_origin,
+)
 
-import altair as alt
-import openai
-import pandas as pd
 import streamlit as st
 import yaml
 from dotenv import load_dotenv
-from openai.types.chat import ChatCompletionMessageParam
+from streamlit.errors import StreamlitAPIException
+
+if TYPE_CHECKING:
+    # openai is slow to import and only needed for feedback, see llm_scheduler()
+    import openai
+    from openai.types.chat import ChatCompletionMessageParam
 
 load_dotenv()
 
@@ -28,14 +56,57 @@ MODELS = [
     None,
 ]
 AUTOMATIC_MODE_MODEL = "gpt-4.1"
+LLM_CONCURRENCY = 8  # Requests to OpenAI in parallel
+LLM_TIMEOUT = 60  # seconds
+LLM_RETRIES = 3
+LLM_BACKOFF = 2  # seconds before the first retry, doubled after each failure
+# The rate limits of the OpenAI account. Each process enforces its own share, so with several
+# workers sharing a workshop, set WORKERS to their number to split the budget between them.
+WORKERS = int(os.getenv("WORKERS", "1"))
+LLM_REQUESTS_PER_MINUTE = 500 / WORKERS
+LLM_TOKENS_PER_MINUTE = 200_000 / WORKERS
+LLM_COMPLETION_TOKENS = 500  # Estimated size of an answer, for the rate limits
+LLM_BATCH_WINDOW = 20  # seconds to wait for similar submissions, to draft them in one request
+LLM_BATCH_SIZE = 20  # submissions per request at most
+LLM_CACHE_PATH = Path("llm_cache.sqlite")
+LLM_CACHE_SIZE = 10_000  # entries
+LLM_CACHE_TTL = 30 * 24 * 60 * 60  # seconds
+LLM_DRAFTS_SIZE = 1000  # drafts kept in memory, older ones are read again from the cache
+LLM_PRICES = {  # USD per million tokens: input, cached input, output
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
 TEACHER_NAME = "Camille"
 LLM_NAME = "LLM"
 TEACHER_NAMES = [TEACHER_NAME, "LLM"]
 
+EXERCISES_PATH = Path("exercises.yaml")
 BACKUP_DIR = Path("backups")
 BACKUP_DIR.mkdir(exist_ok=True)
 BACKUP_FREQUENCY = 5 * 60  # seconds
+# Keep every backup of the last hour, then one per 10 minutes for a day, then one per day.
+# Each item is (maximum age, minimum spacing) in seconds.
+BACKUP_RETENTION = [(60 * 60, 0), (24 * 60 * 60, 10 * 60), (float("inf"), 24 * 60 * 60)]
+# Set to a file to store the database in SQLite, instead of the journal in BACKUP_DIR
+SQLITE_PATH = os.getenv("SQLITE_PATH")
+SYNC_INTERVAL = 0.2  # seconds between checks for changes made by other processes
+# One directory per workshop besides the default one, opened with ?workshop=<name>
+WORKSHOPS_DIR = Path("workshops")
+WORKSHOP_IDLE = 30 * 60  # seconds without any session before a workshop is unloaded
 TIME_PER_QUESTION = 3 * 60
+# Set LIVE_UPDATES=0 to render each page once instead of waiting for changes, e.g. in AppTest
+LIVE_UPDATES = os.getenv("LIVE_UPDATES", "1") != "0"
+ANSWER_TIME_BIN = 30  # seconds, width of the bars in the histogram of answer times
+SIMILAR_SUGGESTIONS = 3  # previous feedback on the closest submissions, shown to the teacher
+SIMILARITY_MIN = 0.3  # submissions less similar than this are not suggested
+NEAR_DUPLICATE = 0.8  # the feedback on a submission this similar is used as the draft
+FEEDBACK_PAGE_SIZE = 5  # questions shown to the teacher at once, the ones waiting the longest
+RECENT_CHATS = 5  # previous chats of the participant shown as context to the teacher
+# Set to a file to write the metrics there in the Prometheus text format, every METRICS_INTERVAL
+METRICS_PATH = os.getenv("METRICS_PATH")
+METRICS_INTERVAL = 15  # seconds
 
 
 @dataclass(frozen=True)
@@ -63,15 +134,122 @@ class Exercise:
         data["examples"] = [Example(**ex) for ex in data["examples"]]
         return cls(**data)
 
+    @cached_property
+    def prompt_prefix(self) -> tuple["ChatCompletionMessageParam", ...]:
+        """The system prompt and few-shot examples, which start every feedback request.
+
+        It is built once and is byte-identical across calls, so that the provider can cache it.
+        Don't modify it.
+        """
+        messages: list[ChatCompletionMessageParam] = [
+            {"role": "system", "content": self.system_prompt}
+        ]
+        for example in self.examples:
+            messages.append(
+                {"role": "user", "content": fmt_submission(example.original, example.student)}
+            )
+            messages.append({"role": "assistant", "content": example.feedback})
+        return tuple(messages)
+
+    @cached_property
+    def prompt_hash(self) -> str:
+        """Changes whenever the system prompt or the examples change, to invalidate feedback."""
+        return hashlib.sha256(json.dumps(self.prompt_prefix).encode()).hexdigest()
+
+
+def fmt_submission(original: str, submission: str) -> str:
+    return f"Original: {original}\nResponse: {submission}"
+
+
+@dataclass(frozen=True)
+class Catalogue:
+    exercises: list[Exercise]
+    by_name: dict[str, Exercise]
+    titles: list[str]
+    """Title of each exercise, from the first header of its instructions"""
+    toc: str
+    """Table of contents of the exercises, in markdown"""
+
+
+def exercise_header(exo: Exercise) -> tuple[str, int]:
+    """The title and depth of the first header in the instructions."""
+    # First line with a # is the title
+    header = next(
+        (line for line in exo.instructions.splitlines() if line.strip().startswith("#")),
+        "no header",
+    )
+    title = header.lstrip("# ")
+    return title, header[: -len(title)].count("#")
+
+
+@st.cache_resource(max_entries=32)  # A few workshops, each edited a few times
+def load_catalogue(path: str, mtime: float) -> Catalogue:
+    """Parse the exercises once per process, and again only when the file is modified."""
+    exercises = [Exercise.from_yaml(d) for d in yaml.safe_load_all(Path(path).read_text())]
+    # Filter for HIDDEN exercises
+    exercises = [exo for exo in exercises if not "HIDDEN" in exo.name]
+    for exo in exercises:
+        _ = exo.prompt_prefix  # Pre-render the prompts. Not a bare expression, for streamlit magic.
+
+    titles = []
+    toc = ""
+    for i, exo in enumerate(exercises):
+        title, depth = exercise_header(exo)
+        titles.append(title)
+        if depth == 1:
+            toc += f"\n[{title}](#exo-{i+1})  "
+        elif depth == 2:
+            toc += f"- [{title}](#exo-{i+1})  "
+        toc += "\n"
+
+    return Catalogue(exercises, {exo.name: exo for exo in exercises}, titles, toc)
+
 
-EXERCISES = [Exercise.from_yaml(d) for d in yaml.safe_load_all(Path("exercises.yaml").read_text())]
-# Filter for HIDDEN exercises
-EXERCISES = [exo for exo in EXERCISES if not "HIDDEN" in exo.name]
+@dataclass(frozen=True)
+class WorkshopFiles:
+    exercises: Path
+    backups: Path
+    sqlite: Path | None
+    """Set when SQLITE_PATH is, None to use the journal in the backups"""
+
+
+def workshop_files(workshop: str) -> WorkshopFiles | None:
+    """
+    Where a workshop is stored, None if there is no such workshop.
+
+    The default workshop, "", uses EXERCISES_PATH, BACKUP_DIR and SQLITE_PATH. The others are
+    created by making a directory in WORKSHOPS_DIR, optionally with their own exercises.yaml.
+    """
+    if not workshop:
+        return WorkshopFiles(EXERCISES_PATH, BACKUP_DIR, Path(SQLITE_PATH) if SQLITE_PATH else None)
+
+    directory = WORKSHOPS_DIR / workshop
+    # The name comes from the URL, so it must not be able to point anywhere else
+    if not workshop.replace("-", "").replace("_", "").isalnum() or not directory.is_dir():
+        return None
+    exercises = directory / "exercises.yaml"
+    return WorkshopFiles(
+        exercises if exercises.exists() else EXERCISES_PATH,
+        directory / "backups",
+        directory / "workshop.sqlite" if SQLITE_PATH else None,
+    )
+
+
+# Each session belongs to one workshop. The script runs again for every interaction,
+# so these are the files and exercises of the workshop of the current session.
+WORKSHOP = st.query_params.get("workshop", "")
+FILES = workshop_files(WORKSHOP)
+if FILES is None:
+    st.error(f"There is no workshop named {WORKSHOP!r}, check the link you were given.")
+    st.stop()
+
+CATALOGUE = load_catalogue(str(FILES.exercises), FILES.exercises.stat().st_mtime)
+EXERCISES = CATALOGUE.exercises
 
 NUM_QUESTIONS = sum(len(exo.variations) for exo in EXERCISES)
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Message:
     user: str
     content: str
@@ -79,13 +257,15 @@ class Message:
     skipped_by_teacher: bool = False
 
 
-@dataclass
+@dataclass(slots=True)
 class Question:
     user: str
     exo: int
     variation: int
     messages: list[Message] = field(default_factory=list)
     uid: str = field(default_factory=lambda: str(uuid.uuid4()))
+    revision: int = field(default=0, compare=False, metadata={"saved": False})
+    """Incremented each time the question changes, see DataBase.wait_for_change"""
 
     @property
     def needs_response_since(self):
@@ -112,28 +292,33 @@ class Question:
             return self.messages[-1].timestamp
         return -1
 
-    @property
-    def variation_text(self) -> str:
-        return EXERCISES[self.exo].variations[self.variation]
+    def variation_text(self, exercises: list[Exercise]) -> str:
+        return exercises[self.exo].variations[self.variation]
 
-    @property
-    def full_exo(self) -> Exercise:
-        return EXERCISES[self.exo]
 
-
-@dataclass
+@dataclass(slots=True)
 class User:
     name: str
     password: str
     exos: list[list[Question]]
-
-    def __init__(self, name: str, password: str, exos: list[list[Question]] | None = None):
+    revision: int = field(default=0, compare=False, metadata={"saved": False})
+
+    def __init__(
+        self,
+        name: str,
+        password: str,
+        exos: list[list[Question]] | None = None,
+        revision: int = 0,
+        exercises: list[Exercise] | None = None,
+    ):
+        """A new user gets one empty question per variation of the `exercises`."""
         self.name = name
         self.password = password
+        self.revision = revision
         if exos is None:
             exos = [
                 [Question(name, e, v) for v in range(len(exo.variations))]
-                for e, exo in enumerate(EXERCISES)
+                for e, exo in enumerate(exercises if exercises is not None else EXERCISES)
             ]
         self.exos = exos
 
@@ -141,87 +326,666 @@ class User:
         return [q for exo in self.exos for q in exo]
 
 
+class AnswerTimes:
+    """Running statistics of the time it takes for the teacher to answer."""
+
+    def __init__(self):
+        # All pairs (user message -> teacher message), sorted
+        self.pairs: list[tuple[float, float]] = []
+        self.sorted_times: list[float] = []
+        self.total = 0.0
+        # Number of answers per bin of ANSWER_TIME_BIN seconds
+        self.histogram: dict[int, int] = {}
+
+    def add(self, sent_at: float, answered_at: float) -> None:
+        duration = answered_at - sent_at
+        bisect.insort(self.pairs, (sent_at, answered_at))
+        bisect.insort(self.sorted_times, duration)
+        self.total += duration
+        b = int(duration // ANSWER_TIME_BIN)
+        # Replaced rather than updated, so that bins() can iterate it while teachers answer
+        self.histogram = {**self.histogram, b: self.histogram.get(b, 0) + 1}
+
+    def __len__(self) -> int:
+        return len(self.pairs)
+
+    def times(self, last_n: int | None = None) -> list[float]:
+        pairs = self.pairs if last_n is None else self.pairs[-last_n:]
+        return [end - start for start, end in pairs]
+
+    def mean(self, last_n: int | None = None) -> float:
+        if not self.pairs:
+            return float("nan")
+        if last_n is None:
+            return self.total / len(self.pairs)
+        times = self.times(last_n)
+        return sum(times) / len(times)
+
+    def percentile(self, p: float) -> float:
+        """The p-th percentile of the answer times, for 0 <= p <= 100 (nearest rank)."""
+        if not self.sorted_times:
+            return float("nan")
+        rank = round(p / 100 * (len(self.sorted_times) - 1))
+        return self.sorted_times[rank]
+
+    def bins(self) -> list[tuple[float, float, int]]:
+        """Return (start, end, count) for each bin of the histogram, in order."""
+        return [
+            (b * ANSWER_TIME_BIN, (b + 1) * ANSWER_TIME_BIN, self.histogram[b])
+            for b in sorted(self.histogram)
+        ]
+
+
+def char_ngrams(text: str, n: int = 3) -> Counter[str]:
+    text = f" {' '.join(text.casefold().split())} "
+    return Counter(text[i : i + n] for i in range(max(1, len(text) - n + 1)))
+
+
+class SimilarityIndex:
+    """
+    Submissions that got feedback from the teacher, per (exercise, variation).
+
+    Submissions are compared as TF-IDF vectors of character trigrams, which is robust to typos
+    and small rephrasings, and fast enough in pure python for the few dozens of submissions to
+    a variation.
+    """
+
+    def __init__(self):
+        # (exo, variation) -> [(trigrams, submission, feedback)]
+        self.entries: dict[tuple[int, int], list[tuple[Counter[str], str, str]]] = {}
+        # (exo, variation) -> number of submissions containing each trigram
+        self.document_frequency: dict[tuple[int, int], Counter[str]] = {}
+
+    def add(self, exo: int, variation: int, submission: str, feedback: str) -> None:
+        ngrams = char_ngrams(submission)
+        self.entries.setdefault((exo, variation), []).append((ngrams, submission, feedback))
+        self.document_frequency.setdefault((exo, variation), Counter()).update(ngrams.keys())
+
+    def size(self, exo: int, variation: int) -> int:
+        return len(self.entries.get((exo, variation), ()))
+
+    def closest(
+        self, exo: int, variation: int, submission: str, k: int
+    ) -> list[tuple[float, str, str]]:
+        """The k most similar submissions, as (cosine similarity, submission, feedback)."""
+        entries = self.entries.get((exo, variation), [])
+        if not entries:
+            return []
+        df = self.document_frequency[exo, variation]
+        n = len(entries)
+
+        def weights(ngrams: Counter[str]) -> tuple[dict[str, float], float]:
+            w = {g: c * (math.log((1 + n) / (1 + df[g])) + 1) for g, c in ngrams.items()}
+            return w, math.sqrt(sum(v * v for v in w.values())) or 1.0
+
+        query, query_norm = weights(char_ngrams(submission))
+        scored = []
+        for ngrams, other, feedback in entries:
+            w, norm = weights(ngrams)
+            dot = sum(v * w[g] for g, v in query.items() if g in w)
+            scored.append((dot / (query_norm * norm), other, feedback))
+        return heapq.nlargest(k, scored, key=lambda x: x[0])
+
+
+class Histogram:
+    """Counts of durations in fixed buckets, like a Prometheus histogram."""
+
+    BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        # counts[i] is the number of durations in (BOUNDS[i-1], BOUNDS[i]], the last is for +Inf
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def __len__(self) -> int:
+        return sum(self.counts)
+
+    def percentile(self, p: float) -> float:
+        """Upper bound of the bucket of the p-th percentile, for 0 <= p <= 100."""
+        rank = p / 100 * len(self)
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """
+    Timings of the hot paths and counters, for the whole process.
+
+    Recording is a dictionary lookup and a few additions under a lock, so it is always on.
+    Sources are functions called only when the metrics are read, for values that other objects
+    already keep, like the hits of the feedback cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings: dict[str, Histogram] = {}
+        self.counters: dict[tuple[str, str], float] = {}  # (name, labels) -> value
+        self.sources: list[Callable[[], dict[str, float]]] = []
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            if name not in self.timings:
+                self.timings[name] = Histogram()
+            self.timings[name].observe(seconds)
+
+    @contextmanager
+    def time(self, name: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    def count(self, name: str, amount: float = 1, **labels: str) -> None:
+        key = (name, ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauges(self) -> dict[str, float]:
+        return {name: value for source in self.sources for name, value in source().items()}
+
+    def summary(self) -> str:
+        """Markdown tables of the timings and counters."""
+        text = "| | count | mean | p50 | p90 | max |\n|-|-|-|-|-|-|\n"
+        with self._lock:
+            for name, h in sorted(self.timings.items()):
+                ms = [h.total / len(h), h.percentile(50), h.percentile(90), h.max]
+                text += f"| {name} | {len(h)} | " + " | ".join(f"{t * 1000:.0f}ms" for t in ms)
+                text += " |\n"
+            values = {
+                f"{name}{{{labels}}}" if labels else name: v
+                for (name, labels), v in sorted(self.counters.items())
+            }
+        values.update(self.gauges())
+        text += "\n| | value |\n|-|-|\n"
+        text += "".join(f"| {name} | {value:.4g} |\n" for name, value in values.items())
+        return text
+
+    def to_prometheus(self, prefix: str = "workshop_") -> str:
+        lines = []
+        with self._lock:
+            for name, h in sorted(self.timings.items()):
+                metric = f"{prefix}{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                seen = 0
+                for bound, count in zip(h.BOUNDS, h.counts):
+                    seen += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {seen}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {len(h)}')
+                lines.append(f"{metric}_sum {h.total}")
+                lines.append(f"{metric}_count {len(h)}")
+
+            for name in sorted({name for name, _ in self.counters}):
+                # Prometheus expects counters to end in _total
+                total = f"{prefix}{name}_total"
+                lines.append(f"# TYPE {total} counter")
+                for (name_, labels), value in sorted(self.counters.items()):
+                    if name_ == name:
+                        metric = f"{total}{{{labels}}}" if labels else total
+                        lines.append(f"{metric} {value}")
+
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            lines.append(f"{prefix}{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def flush_forever(self, path: Path, interval: float = METRICS_INTERVAL) -> None:
+        """Write the metrics to the file every interval, e.g. for node_exporter's textfiles."""
+        while True:
+            sleep(interval)
+            try:
+                tmp = path.with_suffix(".tmp")
+                tmp.write_text(self.to_prometheus())
+                tmp.replace(path)
+            except Exception as e:
+                # E.g. a full disk or a failing source, the next flush may work
+                print(f"Failed to write the metrics to {path}: {e}")
+                traceback.print_exc()
+
+
+@dataclass
+class MergeDiff:
+    """What merging another database adds to this one, see DataBase.diff."""
+
+    users: list[User] = field(default_factory=list)
+    """Users that are not in this database, added with all their questions"""
+    messages: dict[str, list[Message]] = field(default_factory=dict)
+    """Messages to add to the questions of this database, by uid"""
+    known: int = 0
+    """Messages that are in both databases"""
+
+    def summary(self) -> str:
+        added = sum(len(messages) for messages in self.messages.values())
+        return (
+            f"{len(self.users)} new users, {added} new messages on {len(self.messages)} questions"
+            f" of existing users, {self.known} messages already here"
+        )
+
+
 @dataclass
 class DataBase:
     """
     The database is a dictionary of users, each user has a list of exercises, each exercise has a list of questions.
+
+    All sessions share it from their own threads. Writers hold the lock of `_changed` for the
+    whole change, including recording it, so changes are atomic and recorded in the order they
+    were made. Readers take no lock: `users` and the messages of each question are replaced,
+    never modified in place, so whatever a reader holds is a snapshot that never changes under it.
     """
 
     users: dict[str, User] = field(default_factory=dict)
     teacher_password: str | None = None
     version: int = 2
+    revision: int = field(default=0, compare=False, metadata={"saved": False})
+
+    def __post_init__(self):
+        # Not fields: they are neither saved nor compared.
+        self.storage: Storage | None = None
+        self.metrics = Metrics()
+        # The exercises of the workshop, for new users
+        self.exercises: list[Exercise] = EXERCISES
+        # Held by writers, and notified after each change. Reentrant, for _bump.
+        self._changed = threading.Condition(threading.RLock())
+        self._reindex()
+
+    def _reindex(self) -> None:
+        """Rebuild the indices after the users were replaced."""
+        self._questions: dict[str, Question] = {q.uid: q for q in self.all_questions()}
+        # The questions of each user in order, the index of the first one without messages,
+        # and the time of their last message. For the timer, which runs every second.
+        self._ordered: dict[str, list[Question]] = {
+            name: user.all_questions() for name, user in self.users.items()
+        }
+        self._next_question: dict[str, int] = {}
+        self._last_message_time: dict[str, float] = {}
+        # The RECENT_CHATS + 1 questions of each user with the latest messages, as sorted
+        # (-last message time, uid). One more, so that the question being answered can be left out.
+        self._recent: dict[str, list[tuple[float, str]]] = {}
+        # Questions needing feedback, as a sorted tuple of (waiting since, uid),
+        # indexed by uid so that entries can be found by bisection.
+        self._waiting_since: dict[str, float] = {
+            q.uid: since
+            for q in self._questions.values()
+            if (since := q.needs_response_since) is not None
+        }
+        self._queue = tuple(sorted((since, uid) for uid, since in self._waiting_since.items()))
+        # Running statistics of answer times, and when the unanswered messages were sent.
+        self._answer_times = AnswerTimes()
+        self._unanswered_since: dict[str, float] = {}
+        # Teacher feedback by submission, built on the first suggestion since most loads, like
+        # the backups, never need it. And the suggestions for each uid with the index size.
+        self._similar: SimilarityIndex | None = None
+        self._suggestions: dict[str, tuple[int, list[tuple[float, str, str]]]] = {}
+        for q in self._questions.values():
+            for message in q.messages:
+                self._track_answer_time(q, message)
+        # What _track maintains message by message, computed once per user
+        for name, questions in self._ordered.items():
+            answered = [q for q in questions if q.messages]
+            self._next_question[name] = next(
+                (i for i, q in enumerate(questions) if not q.messages), len(questions)
+            )
+            if answered:
+                self._last_message_time[name] = max(
+                    m.timestamp for q in answered for m in q.messages
+                )
+                recent = sorted((-q.last_message_time, q.uid) for q in answered)
+                self._recent[name] = recent[: RECENT_CHATS + 1]
+
+    def _track(self, question: Question, message: Message) -> None:
+        self._track_answer_time(question, message)
+
+        user = question.user
+        last = self._last_message_time.get(user, message.timestamp)
+        self._last_message_time[user] = max(last, message.timestamp)
+        # Questions are answered in order, so the pointer only moves forward
+        questions = self._ordered.get(user, [])
+        i = self._next_question.get(user, 0)
+        while i < len(questions) and questions[i].messages:
+            i += 1
+        self._next_question[user] = i
+
+        recent = [entry for entry in self._recent.get(user, []) if entry[1] != question.uid]
+        bisect.insort(recent, (-question.last_message_time, question.uid))
+        self._recent[user] = recent[: RECENT_CHATS + 1]
+
+        if self._similar is not None and self._first_feedback(question) is message:
+            self._similar.add(
+                question.exo, question.variation, question.messages[0].content, message.content
+            )
+
+    @staticmethod
+    def _first_feedback(question: Question) -> Message | None:
+        """The first feedback of the teacher on the first submission, which is what is indexed."""
+        if not question.messages or question.messages[0].user == TEACHER_NAME:
+            return None
+        return next((m for m in question.messages if m.user == TEACHER_NAME), None)
+
+    def _similarity_index(self) -> SimilarityIndex:
+        with self._changed:
+            if self._similar is None:
+                # Built aside, so that readers never see it half-filled
+                similar = SimilarityIndex()
+                for q in self._questions.values():
+                    feedback = self._first_feedback(q)
+                    if feedback is not None:
+                        similar.add(q.exo, q.variation, q.messages[0].content, feedback.content)
+                self._similar = similar
+            return self._similar
+
+    def _track_answer_time(self, question: Question, message: Message) -> None:
+        # We collect all pairs (user message -> teacher message)
+        # With the maximum number of user messages in between
+        if message.user == TEACHER_NAME:
+            sent_at = self._unanswered_since.pop(question.uid, None)
+            if sent_at is not None:
+                self._answer_times.add(sent_at, message.timestamp)
+        else:
+            self._unanswered_since.setdefault(question.uid, message.timestamp)
+
+    def _update_queue(self, question: Question) -> None:
+        # Finding the entry is O(log n), but the queue is copied, so that readers need no lock, and
+        # inserting and deleting shift the rest of it: O(n). For the few hundred questions of a
+        # workshop, that is a memmove that costs less than a heap with lazy deletion, which would
+        # have to be sorted to be listed in order.
+        since = question.needs_response_since
+        old = self._waiting_since.get(question.uid)
+        if since == old:
+            return
+        queue = list(self._queue)
+        if old is not None:
+            del queue[bisect.bisect_left(queue, (old, question.uid))]
+            del self._waiting_since[question.uid]
+            # Suggestions are only shown for the questions in the queue
+            self._suggestions.pop(question.uid, None)
+        if since is not None:
+            bisect.insort(queue, (since, question.uid))
+            self._waiting_since[question.uid] = since
+        self._queue = tuple(queue)
 
     def reload(self, path: Path) -> Self:
-        other = DataBase.from_json(json.loads(path.read_text()))
-        self.__dict__.update(other.__dict__)
+        data = path.read_bytes()
+        if path.suffix == ".gz":
+            data = gzip.decompress(data)
+        other = DataBase.from_json(json.loads(data))
+        self.teacher_password = other.teacher_password
+        self._adopt(other)
         return self
 
+    def _adopt(self, other: "DataBase") -> None:
+        """Take the users of `other` with its indices, which are all its private attributes.
+
+        The indices are replaced first, so that readers who see the new users also find them.
+        """
+        for name, value in vars(other).items():
+            if name.startswith("_") and name != "_changed":
+                setattr(self, name, value)
+        self.users = other.users
+
+    @contextmanager
+    def frozen(self) -> Iterator[None]:
+        """Make no change until the end of the block, e.g. to save a consistent state."""
+        with self._changed:
+            yield
+
     def save(self, path: Path) -> None:
-        path.write_text(json.dumps(dataclass_to_dict(self), indent=2))
+        write_json(path, dataclass_to_dict(self))
 
     def login(self, user: str, password: str) -> bool:
         """Create a new user if it doesn't exist"""
-        if user == TEACHER_NAME:
-            if self.teacher_password is None:
-                self.teacher_password = password
-            return self.teacher_password == password
-        if user not in self.users:
-            # Create a new account
-            self.users[user] = User(user, password)
-        elif self.users[user].password != password:
-            return False
+        with self._changed:
+            if user == TEACHER_NAME:
+                if self.teacher_password is None:
+                    self.teacher_password = password
+                    self._record(op="teacher", password=password)
+                return self.teacher_password == password
+            if user not in self.users:
+                # Create a new account
+                self._add_user(User(user, password, exercises=self.exercises))
+                self._record(op="user", user=dataclass_to_dict(self.users[user]))
+                self._bump(self.users[user])
+            elif self.users[user].password != password:
+                return False
+        self._checkpoint()
         return True
 
-    def questions_needing_feedback(self) -> list[Question]:
-        need_response = [q for q in self.all_questions() if q.needs_response_since is not None]
-        need_response.sort(key=lambda q: q.needs_response_since)
-        return need_response
+    def add_message(self, question: Question, message: Message) -> None:
+        with self._changed:
+            self._append(question, message)
+            self._record(op="message", uid=question.uid, message=dataclass_to_dict(message))
+            self._bump(self.users[question.user], question=question)
+        self._checkpoint()
+
+    def skip(self, question: Question) -> None:
+        """Mark the last message of the question as not needing a response."""
+        with self._changed:
+            # Another teacher may have answered or skipped it since it was shown
+            if question.needs_response_since is None:
+                return
+            self._skip_last(question)
+            self._record(op="skip", uid=question.uid)
+            self._bump(self.users[question.user], question=question)
+        self._checkpoint()
+
+    def replace_users(self, users: dict[str, User], record: bool = True) -> None:
+        """Replace all the users at once, e.g. to wipe the database or load a backup."""
+        with self._changed:
+            self._adopt(DataBase(dict(users)))
+            if record and self.storage is not None:
+                self.storage.snapshot(self)
+            self._bump(*users.values())
+
+    def diff(self, other: "DataBase") -> MergeDiff:
+        """
+        What merging `other` would add, without changing anything.
+
+        Questions are matched by uid, or by user, exercise and variation when the user was created
+        again. Two messages on the same question are the same if they have the same author and
+        timestamp.
+        """
+        diff = MergeDiff()
+        for name, user in other.users.items():
+            mine = self.users.get(name)
+            if mine is None:
+                diff.users.append(user)
+                continue
+            for q in user.all_questions():
+                target = self.find_question(q.uid)
+                if (
+                    target is None
+                    and q.exo < len(mine.exos)
+                    and q.variation < len(mine.exos[q.exo])
+                ):
+                    target = mine.exos[q.exo][q.variation]
+                if target is None:
+                    continue
+                known = {(m.user, m.timestamp) for m in target.messages}
+                new = [m for m in q.messages if (m.user, m.timestamp) not in known]
+                diff.known += len(q.messages) - len(new)
+                if new:
+                    diff.messages[target.uid] = new
+        return diff
+
+    def merge(self, other: "DataBase") -> MergeDiff:
+        """Add the users and messages of `other` that are not here, and return what was added."""
+        with self._changed:
+            diff = self.diff(other)
+            if not diff.users and not diff.messages:
+                return diff
+            # Copies, so that the two databases never share a question
+            users = {u.name: dict_to_dataclass(User, dataclass_to_dict(u)) for u in diff.users}
+            changed = list(users.values())
+            for uid, messages in diff.messages.items():
+                question = self._questions[uid]
+                question.messages = sorted(
+                    [*question.messages, *messages], key=lambda m: m.timestamp
+                )
+                question.revision += 1
+                changed.append(self.users[question.user])
+            # Messages may be inserted before others, so the indices and the log start over
+            self._adopt(DataBase({**self.users, **users}))
+            if self.storage is not None:
+                self.storage.snapshot(self)
+            self._bump(*changed)
+        return diff
+
+    def notify(self) -> None:
+        """Wake up the sessions waiting for a change, e.g. when an LLM draft is ready."""
+        self._bump()
+
+    def find_question(self, uid: str) -> Question | None:
+        return self._questions.get(uid)
+
+    def _append(self, question: Question, message: Message) -> None:
+        question.messages = [*question.messages, message]
+        self._track(question, message)
+
+    def _skip_last(self, question: Question) -> None:
+        *previous, last = question.messages
+        question.messages = [*previous, dataclasses.replace(last, skipped_by_teacher=True)]
+
+    def _add_user(self, user: User) -> None:
+        self._ordered[user.name] = user.all_questions()
+        for q in user.all_questions():
+            self._questions[q.uid] = q
+        # Last, so that readers who see the user also find its questions
+        self.users = {**self.users, user.name: user}
+
+    def _bump(self, *users: User, question: Question | None = None) -> None:
+        """Increment the revision of the database and the changed objects, and wake up waiters."""
+        # No isinstance checks here: streamlit redefines the classes on every rerun.
+        with self._changed:
+            for user in users:
+                user.revision += 1
+            if question is not None:
+                question.revision += 1
+                self._update_queue(question)
+            self.revision += 1
+            self._changed.notify_all()
+
+    def wait_for_change(
+        self,
+        watched: "list[DataBase] | list[User] | list[Question]",
+        seen: list[int],
+        timeout: float | None = None,
+    ) -> bool:
+        """Block until the revisions of `watched` differ from `seen`. Return False on timeout."""
+        with self._changed:
+            return self._changed.wait_for(lambda: [w.revision for w in watched] != seen, timeout)
+
+    def _record(self, **event) -> None:
+        if self.storage is not None:
+            with self.metrics.time("storage_record"):
+                self.storage.record(self, event)
+
+    def _checkpoint(self) -> None:
+        # After the change and out of the lock, so that writers never wait for a snapshot
+        if self.storage is not None:
+            self.storage.checkpoint(self)
+
+    def apply(self, event: dict) -> None:
+        """Replay one event recorded by the storage, without recording it again."""
+        with self._changed:
+            match event["op"]:
+                case "teacher":
+                    self.teacher_password = event["password"]
+                case "user":
+                    user = dict_to_dataclass(User, event["user"])
+                    self._add_user(user)
+                    self._bump(user)
+                case "message":
+                    q = self.find_question(event["uid"])
+                    if q is not None:
+                        self._append(q, dict_to_dataclass(Message, event["message"]))
+                        self._bump(self.users[q.user], question=q)
+                case "skip":
+                    q = self.find_question(event["uid"])
+                    if q is not None and q.messages:
+                        self._skip_last(q)
+                        self._bump(self.users[q.user], question=q)
+                case op:
+                    print(f"Unknown journal event {op!r}, ignoring it")
+
+    def questions_needing_feedback(self, limit: int | None = None) -> list[Question]:
+        """Questions waiting for a response, the `limit` ones waiting for the longest first."""
+        # Replaced, never modified. Questions can only be missing while all users are replaced.
+        queue = self._queue
+        questions = self._questions
+        return [questions[uid] for _, uid in queue[:limit] if uid in questions]
+
+    def num_needing_feedback(self) -> int:
+        return len(self._queue)
+
+    def recent_chats(self, question: Question) -> list[Question]:
+        """The RECENT_CHATS other questions of the user with the latest messages, latest first."""
+        recent = self._recent.get(question.user, [])
+        return [self._questions[uid] for _, uid in recent if uid != question.uid][:RECENT_CHATS]
 
     def questions_done(self, user: str) -> int:
         return sum(1 for q in self.users[user].all_questions() if q.messages)
 
+    def current_question(self, user: str) -> Question | None:
+        """The first question of the user without messages, None once they answered all."""
+        questions = self._ordered.get(user, [])
+        i = self._next_question.get(user, 0)
+        return questions[i] if i < len(questions) else None
+
+    def last_message_time(self, user: str) -> float | None:
+        """When the last message on the questions of the user was sent, by anyone."""
+        return self._last_message_time.get(user)
+
     def all_questions(self) -> list[Question]:
         return [q for user in self.users.values() for q in user.all_questions()]
 
-    def answer_times(self, last_n: int | None = None) -> list[float]:
-        """Return the mean time it takes for the teacher to answer a question."""
-
-        answered = [
-            q
-            for q in self.all_questions()
-            if any(message.user == TEACHER_NAME for message in q.messages)
-        ]
+    def similar_feedback(self, question: Question) -> list[tuple[float, str, str]]:
+        """Feedback of the teacher on the submissions closest to the first one of the question.
+
+        Returns up to SIMILAR_SUGGESTIONS (similarity, submission, feedback), most similar first.
+        """
+        if not question.messages:
+            return []
+        similar = self._similar or self._similarity_index()
+        size = similar.size(question.exo, question.variation)
+        cached = self._suggestions.get(question.uid)
+        if cached is None or cached[0] != size:
+            closest = similar.closest(
+                question.exo, question.variation, question.messages[0].content, SIMILAR_SUGGESTIONS
+            )
+            cached = size, [c for c in closest if c[0] >= SIMILARITY_MIN]
+            self._suggestions[question.uid] = cached
+        return cached[1]
 
-        # We collect all pairs (user message -> teacher message)
-        # With the maximum number of user messages in between
-        times = []
-        for q in answered:
-            sent_at = 0
-            for message in q.messages:
-                if message.user == TEACHER_NAME:
-                    if sent_at != 0:
-                        times.append((sent_at, message.timestamp))
-                    else:
-                        # Two teacher messages in a row
-                        pass
-                    sent_at = 0
-                elif sent_at == 0:
-                    sent_at = message.timestamp
-                else:
-                    # Two user messages in a row
-                    pass
+    def near_duplicate_feedback(self, question: Question) -> str | None:
+        """The feedback on a submission almost identical to the question's, which can be reused."""
+        suggestions = self.similar_feedback(question)
+        if suggestions and suggestions[0][0] >= NEAR_DUPLICATE:
+            return suggestions[0][2]
+        return None
 
-        if last_n is not None:
-            times.sort()
-            times = times[-last_n:]
+    def progress(self) -> dict[str, int]:
+        """Number of questions done by each user."""
+        return {user: self.questions_done(user) for user in self.users}
 
-        return [end - start for start, end in times]
+    def answer_times(self, last_n: int | None = None) -> list[float]:
+        """Return the times it took the teacher to answer, for the last_n most recent messages."""
+        return self._answer_times.times(last_n)
 
     def mean_answer_time(self, last_n: int | None = None) -> float:
-        times = self.answer_times(last_n)
-        if times:
-            return sum(times) / len(times)
-        return float("nan")
+        return self._answer_times.mean(last_n)
+
+    @property
+    def answer_time_stats(self) -> AnswerTimes:
+        return self._answer_times
 
     @classmethod
     def from_json(cls, data: dict) -> Self:
@@ -236,9 +1000,79 @@ class DataBase:
         return dataclass_to_dict(self)
 
 
+# How to convert each type to and from JSON data. They are planned once from the annotations,
+# so that converting is a single pass without any introspection.
+_ENCODERS: dict[Any, Callable[[Any], Any]] = {}
+_DECODERS: dict[Any, Callable[[Any], Any]] = {}
+
+
+def _identity(x: Any) -> Any:
+    return x
+
+
+def _encoder(tp: Any) -> Callable[[Any], Any]:
+    if (encode := _ENCODERS.get(tp)) is not None:
+        return encode
+
+    if is_dataclass(tp):
+        # Fields with metadata saved=False are runtime state, like the revisions
+        saved = [f for f in fields(tp) if f.metadata.get("saved", True)]
+        names = [f.name for f in saved]
+        converted = [(f.name, e) for f in saved if (e := _encoder(f.type)) is not _identity]
+
+        def encode(obj: Any) -> dict:
+            data = {name: getattr(obj, name) for name in names}
+            for name, convert in converted:
+                data[name] = convert(data[name])
+            return data
+
+    elif get_origin(tp) is list:
+        item = _encoder(get_args(tp)[0])
+        encode = list if item is _identity else lambda v: [item(x) for x in v]
+    elif get_origin(tp) is dict:
+        value = _encoder(get_args(tp)[1])
+        encode = dict if value is _identity else lambda v: {k: value(x) for k, x in v.items()}
+    else:
+        encode = _identity
+
+    _ENCODERS[tp] = encode
+    return encode
+
+
+def _decoder(tp: Any) -> Callable[[Any], Any]:
+    if (decode := _DECODERS.get(tp)) is not None:
+        return decode
+
+    if is_dataclass(tp):
+        converted = [(f.name, d) for f in fields(tp) if (d := _decoder(f.type)) is not _identity]
+        # Files saved before runtime state was left out still have it
+        unsaved = [f.name for f in fields(tp) if not f.metadata.get("saved", True)]
+
+        def decode(data: dict) -> Any:
+            kwargs = dict(data)
+            for name in unsaved:
+                kwargs.pop(name, None)
+            for name, convert in converted:
+                if name in kwargs:
+                    kwargs[name] = convert(kwargs[name])
+            return tp(**kwargs)
+
+    elif get_origin(tp) is list:
+        item = _decoder(get_args(tp)[0])
+        decode = list if item is _identity else lambda v: [item(x) for x in v]
+    elif get_origin(tp) is dict:
+        value = _decoder(get_args(tp)[1])
+        decode = dict if value is _identity else lambda v: {k: value(x) for k, x in v.items()}
+    else:
+        decode = _identity
+
+    _DECODERS[tp] = decode
+    return decode
+
+
 def dataclass_to_dict(obj: Any) -> Any:
     if is_dataclass(obj):
-        return {k: dataclass_to_dict(v) for k, v in asdict(obj).items()}
+        return _encoder(type(obj))(obj)
     elif isinstance(obj, list):
         return [dataclass_to_dict(i) for i in obj]
     elif isinstance(obj, dict):
@@ -252,80 +1086,1199 @@ T = TypeVar("T")
 
 def dict_to_dataclass(cls: Type[T], data: Any) -> T:
     try:
-        if isinstance(data, dict):
-            if is_dataclass(cls):
-                fieldtypes = {f.name: f.type for f in fields(cls)}
-                return cls(**{f: dict_to_dataclass(fieldtypes[f], data[f]) for f in data})
-            else:
-                # It can also just be a simple dict
-                return cls(**{k: dict_to_dataclass(cls.__args__[1], v) for k, v in data.items()})
-        elif isinstance(data, list):
-            elem_type = cls.__args__[0]
-            return [dict_to_dataclass(elem_type, i) for i in data]
-        else:
-            return data
+        return _decoder(cls)(data)
     except Exception as e:
         print(f"Error when converting {data} to {cls}")
         raise e
 
 
-if __name__ == "__main__":
-    d = DataBase()
-    d.login("Diego", "123")
-    j = dataclass_to_dict(d)
-    d2 = DataBase.from_json(j)
-    assert d == d2
+def write_json(path: Path, data: Any) -> None:
+    """Write compact JSON, compressed if the path ends in .gz."""
+    text = json.dumps(data, separators=(",", ":")).encode()
+    if path.suffix == ".gz":
+        text = gzip.compress(text, compresslevel=6)
+    path.write_bytes(text)
+
+
+class Storage(abc.ABC):
+    """
+    Where the database is persisted.
+
+    The database calls `record` after each change, with the same events as DataBase.apply, and
+    `snapshot` when all users are replaced at once. Both are called while changes are locked.
+    """
+
+    @abc.abstractmethod
+    def load(self) -> "DataBase":
+        """Load the database and attach it to this storage."""
+
+    @abc.abstractmethod
+    def record(self, database: "DataBase", event: dict) -> None: ...
+
+    @abc.abstractmethod
+    def snapshot(self, database: "DataBase") -> None: ...
+
+    def checkpoint(self, database: "DataBase") -> None:
+        """Periodic work, like snapshots, called after each change once the lock is released."""
+
+    def close(self) -> None:
+        """Stop what was started by `load`, when the database is unloaded."""
+
+
+@dataclass(frozen=True)
+class Backup:
+    path: Path
+    timestamp: int
+    progress: dict[str, int] | None
+    """Number of questions done by each user, None if the backup is not in the manifest"""
+
+
+class Journal(Storage):
+    """
+    Append-only persistence for the database.
+
+    Every BACKUP_FREQUENCY seconds, a full snapshot is written to `<ts>.json.gz`, and every change
+    after it is appended as one JSON line to `<ts>.jsonl`. The state is the latest snapshot plus
+    the replay of its log.
+
+    Old snapshots are thinned out following BACKUP_RETENTION. The manifest has one line per
+    snapshot with the progress of each user, to list the backups without opening them.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.manifest = directory / "manifest.jsonl"
+        self.log: Path | None = None
+        self.last_snapshot = 0.0
+        self._last_ts = 0
+
+    @staticmethod
+    def timestamp(path: Path) -> int:
+        return int(path.name.partition(".")[0])
+
+    def snapshots(self) -> list[Path]:
+        """All snapshots, most recent first. Snapshots in .json are from before compression."""
+        files = [*self.directory.glob("*.json.gz"), *self.directory.glob("*.json")]
+        return sorted(files, key=self.timestamp, reverse=True)
+
+    def backups(self) -> list[Backup]:
+        """All snapshots with the progress of each user, most recent first."""
+        progress = {}
+        for entry in self._read_manifest():
+            progress[entry["file"]] = entry["progress"]
+        return [
+            Backup(path, self.timestamp(path), progress.get(path.name)) for path in self.snapshots()
+        ]
+
+    def append(self, event: dict) -> None:
+        assert self.log is not None, "Take a snapshot before appending to the journal"
+        with self.log.open("a") as f:
+            f.write(json.dumps(event) + "\n")
+
+    def record(self, database: "DataBase", event: dict) -> None:
+        self.append(event)
+
+    def checkpoint(self, database: "DataBase") -> None:
+        if time() - self.last_snapshot > BACKUP_FREQUENCY:
+            self.snapshot(database, unless_since=BACKUP_FREQUENCY)
+
+    def snapshot(self, database: "DataBase", unless_since: float = 0) -> None:
+        """Snapshot the database, unless one was taken in the last `unless_since` seconds."""
+        # Only the state and the switch to its log must be done with changes locked. Converting
+        # is fast, writing and compressing are done without the lock.
+        with database.frozen():
+            now = time()
+            if unless_since and now - self.last_snapshot < unless_since:
+                return  # Another session was first
+            ts = max(int(now), self._last_ts + 1)
+            # Never overwrite a previous snapshot, its log would be replayed twice otherwise
+            while (self.directory / f"{ts}.json.gz").exists() or (
+                self.directory / f"{ts}.json"
+            ).exists():
+                ts += 1
+            data = dataclass_to_dict(database)
+            progress = database.progress()
+            self._last_ts = ts
+            self.log = self.directory / f"{ts}.jsonl"
+            self.last_snapshot = now
+
+        path = self.directory / f"{ts}.json.gz"
+        # Write then rename, so that a crash never leaves a half-written snapshot.
+        tmp = self.directory / f"{ts}.{uuid.uuid4().hex}.tmp.gz"
+        write_json(tmp, data)
+        tmp.replace(path)
+
+        entry = {"file": path.name, "timestamp": ts, "progress": progress}
+        with self.manifest.open("a") as f:
+            f.write(json.dumps(entry) + "\n")
+        self.prune(now)
+
+    def prune(self, now: float) -> None:
+        """Remove the snapshots, and their logs, that BACKUP_RETENTION doesn't keep."""
+        kept = set()
+        removed = False
+        for path in self.snapshots():
+            ts = self.timestamp(path)
+            tier, spacing = next(
+                (i, spacing)
+                for i, (max_age, spacing) in enumerate(BACKUP_RETENTION)
+                if now - ts < max_age
+            )
+            # Keep the most recent snapshot of each period
+            period = (tier, ts // spacing if spacing else ts)
+            if period in kept:
+                path.unlink(missing_ok=True)
+                (self.directory / f"{ts}.jsonl").unlink(missing_ok=True)
+                removed = True
+            else:
+                kept.add(period)
+
+        if removed:
+            names = {path.name for path in self.snapshots()}
+            entries = [entry for entry in self._read_manifest() if entry["file"] in names]
+            tmp = self.manifest.with_name(f"manifest.{uuid.uuid4().hex}.tmp")
+            tmp.write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+            tmp.replace(self.manifest)
+
+    def _read_manifest(self) -> list[dict]:
+        if not self.manifest.exists():
+            return []
+        entries = []
+        for line in self.manifest.read_text().splitlines():
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Another process may be writing the last line
+                continue
+        return entries
+
+    def load(self) -> "DataBase":
+        """Load the latest snapshot, replay its log and start journaling to a fresh snapshot."""
+        snapshots = self.snapshots()
+        if snapshots:
+            print(f"Loading backup from {snapshots[0]}")
+            database = self.replay(snapshots[0])
+            # A log without its snapshot is from a crash while the snapshot was written.
+            # It continues the log of the previous one.
+            for log in sorted(self.directory.glob("[0-9]*.jsonl"), key=self.timestamp):
+                if self.timestamp(log) > self.timestamp(snapshots[0]):
+                    print(f"Replaying {log}, whose snapshot is missing")
+                    self._replay_log(database, log)
+        else:
+            database = DataBase()
+
+        self.snapshot(database)
+        database.storage = self
+        return database
+
+    def replay(self, snapshot: Path) -> "DataBase":
+        """The state at the end of the log of the snapshot, i.e. until the next snapshot."""
+        database = DataBase().reload(snapshot)
+        log = self.directory / f"{self.timestamp(snapshot)}.jsonl"
+        if log.exists():
+            self._replay_log(database, log)
+        return database
+
+    def _replay_log(self, database: "DataBase", log: Path) -> None:
+        with log.open() as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be truncated if we crashed while writing it.
+                    print(f"Skipping corrupted journal line: {line!r}")
+                    continue
+                database.apply(event)
+
+    def states(self) -> Iterator["DataBase"]:
+        """The state of each snapshot, most recent first, loaded one at a time."""
+        for path in self.snapshots():
+            yield self.replay(path)
+
+
+class SqliteStorage(Storage):
+    """
+    Store the database in SQLite, one row per user, question and message.
+
+    Each change is a single row write, so nothing is lost in a crash. The JSON snapshots in
+    BACKUP_DIR are still written every BACKUP_FREQUENCY seconds, for the backup picker.
+
+    Several processes can share the same file: each change is also appended to the events
+    table, and every process replays the events of the others into its own database.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, password TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS questions (
+        uid TEXT PRIMARY KEY,
+        user TEXT NOT NULL REFERENCES users (name),
+        exo INTEGER NOT NULL,
+        variation INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS questions_user ON questions (user, exo, variation);
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        question TEXT NOT NULL REFERENCES questions (uid),
+        user TEXT NOT NULL,
+        content TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        skipped_by_teacher INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS messages_question ON messages (question, id);
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY,
+        worker TEXT NOT NULL,
+        created REAL NOT NULL,
+        event TEXT NOT NULL
+    );
+    """
+
+    def __init__(self, path: Path, backup_dir: Path = BACKUP_DIR):
+        self.path = path
+        self.backups = Journal(backup_dir)
+        self.worker = str(uuid.uuid4())
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        # Transactions are committed at the end of each `with self._conn` block
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+
+    def load(self) -> "DataBase":
+        users, teacher_password, last_event = self._read()
+        with self._lock:
+            # The user_version is 0 only for a new file
+            new_file = self._conn.execute("PRAGMA user_version").fetchone()[0] == 0
+            self._conn.execute("PRAGMA user_version = 1")
+
+        if new_file and self.backups.snapshots():
+            # Import the JSON backups the first time SQLite is used
+            print(f"Importing the latest backup into {self.path}")
+            database = self.backups.load()
+            self.snapshot(database)
+        else:
+            print(f"Loaded {len(users)} users from {self.path}")
+            database = DataBase(users, teacher_password)
+            self.checkpoint(database)
+        database.storage = self
+
+        threading.Thread(
+            target=self._sync, args=(database, last_event), name="sqlite-sync", daemon=True
+        ).start()
+        return database
+
+    def _read(self) -> tuple[dict[str, "User"], str | None, int]:
+        """Read the users, the teacher password and the id of the last event, consistently."""
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")  # Read everything from the same state of the file
+            settings = dict(self._conn.execute("SELECT key, value FROM settings"))
+            messages: dict[str, list[Message]] = {}
+            for question, user, content, timestamp, skipped in self._conn.execute(
+                "SELECT question, user, content, timestamp, skipped_by_teacher"
+                " FROM messages ORDER BY id"
+            ):
+                messages.setdefault(question, []).append(
+                    Message(user, content, timestamp, bool(skipped))
+                )
+            users = {
+                name: User(name, password, exos=[])
+                for name, password in self._conn.execute(
+                    "SELECT name, password FROM users ORDER BY rowid"
+                )
+            }
+            for uid, user, exo, variation in self._conn.execute(
+                "SELECT uid, user, exo, variation FROM questions ORDER BY user, exo, variation"
+            ):
+                exos = users[user].exos
+                while len(exos) <= exo:
+                    exos.append([])
+                exos[exo].append(Question(user, exo, variation, messages.get(uid, []), uid))
+            last_event = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+        return users, settings.get("teacher_password"), last_event
+
+    def _sync(self, database: "DataBase", last_event: int) -> None:
+        """Apply the changes made by other processes to the database, until closed."""
+        conn = sqlite3.connect(self.path)
+        data_version = None
+        while not self._closed.wait(SYNC_INTERVAL):
+            # Only changes when some connection commits, so idle checks are cheap
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == data_version:
+                continue
+            data_version = version
+
+            try:
+                rows = conn.execute(
+                    "SELECT id, worker, event FROM events WHERE id > ? ORDER BY id", (last_event,)
+                ).fetchall()
+                for event_id, worker, event in rows:
+                    last_event = event_id
+                    if worker == self.worker:
+                        continue
+                    event = json.loads(event)
+                    if event["op"] == "snapshot":
+                        # Everything was replaced, reload it all. It includes the next events.
+                        users, database.teacher_password, last_event = self._read()
+                        database.replace_users(users, record=False)
+                        break
+                    database.apply(event)
+            except Exception as e:
+                print(f"Failed to sync with {self.path}: {e}")
+                traceback.print_exc()
+        conn.close()
+
+    def close(self) -> None:
+        self._closed.set()
+        with self._lock:
+            self._conn.close()
+
+    def record(self, database: "DataBase", event: dict) -> None:
+        with self._lock, self._conn:
+            self._add_event(event)
+            match event["op"]:
+                case "teacher":
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO settings VALUES ('teacher_password', ?)",
+                        (event["password"],),
+                    )
+                case "user":
+                    self._insert_user(dict_to_dataclass(User, event["user"]))
+                case "message":
+                    m = event["message"]
+                    self._conn.execute(
+                        "INSERT INTO messages"
+                        " (question, user, content, timestamp, skipped_by_teacher)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        (
+                            event["uid"],
+                            m["user"],
+                            m["content"],
+                            m["timestamp"],
+                            m["skipped_by_teacher"],
+                        ),
+                    )
+                case "skip":
+                    self._conn.execute(
+                        "UPDATE messages SET skipped_by_teacher = 1 WHERE id ="
+                        " (SELECT MAX(id) FROM messages WHERE question = ?)",
+                        (event["uid"],),
+                    )
+
+    def checkpoint(self, database: "DataBase") -> None:
+        """Snapshot to BACKUP_DIR if no process did in the last BACKUP_FREQUENCY seconds."""
+        now = time()
+        if now - self.backups.last_snapshot < BACKUP_FREQUENCY:
+            return
+        # Only one process takes each snapshot, the one whose UPDATE goes through first
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO settings VALUES ('last_snapshot', 0)")
+            claimed = self._conn.execute(
+                "UPDATE settings SET value = ?"
+                " WHERE key = 'last_snapshot' AND CAST(value AS REAL) < ?",
+                (now, now - BACKUP_FREQUENCY),
+            ).rowcount
+            if claimed:
+                # Other processes have long applied them
+                self._conn.execute("DELETE FROM events WHERE created < ?", (now - 3600,))
+        # Checking SQLite once per BACKUP_FREQUENCY is enough, even when another process won
+        self.backups.last_snapshot = now
+        if claimed:
+            self.backups.snapshot(database)
+
+    def _add_event(self, event: dict) -> None:
+        self._conn.execute(
+            "INSERT INTO events (worker, created, event) VALUES (?, ?, ?)",
+            (self.worker, time(), json.dumps(event)),
+        )
+
+    def snapshot(self, database: "DataBase") -> None:
+        with self._lock, self._conn:
+            self._add_event({"op": "snapshot"})
+            for table in ("messages", "questions", "users", "settings"):
+                self._conn.execute(f"DELETE FROM {table}")
+            if database.teacher_password is not None:
+                self._conn.execute(
+                    "INSERT INTO settings VALUES ('teacher_password', ?)",
+                    (database.teacher_password,),
+                )
+            self._conn.execute("INSERT INTO settings VALUES ('last_snapshot', ?)", (time(),))
+            for user in database.users.values():
+                self._insert_user(user)
+        self.backups.snapshot(database)
+
+    def _insert_user(self, user: "User") -> None:
+        self._conn.execute("INSERT OR REPLACE INTO users VALUES (?, ?)", (user.name, user.password))
+        for q in user.all_questions():
+            self._conn.execute(
+                "INSERT OR REPLACE INTO questions (uid, user, exo, variation) VALUES (?, ?, ?, ?)",
+                (q.uid, q.user, q.exo, q.variation),
+            )
+            self._conn.executemany(
+                "INSERT INTO messages (question, user, content, timestamp, skipped_by_teacher)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [(q.uid, m.user, m.content, m.timestamp, m.skipped_by_teacher) for m in q.messages],
+            )
+
+
+TRANSCRIPT_COLUMNS = [
+    "user",
+    "exercise",
+    "variation",
+    "question",
+    "author",
+    "role",
+    "timestamp",
+    "latency",
+    "skipped",
+    "content",
+]
+
+
+def transcript_rows(users: Iterable[User], exercises: list[Exercise]) -> Iterator[list]:
+    """
+    One flat row per message, with the TRANSCRIPT_COLUMNS.
+
+    Timestamps are in seconds since the epoch. The latency of feedback is the number of seconds
+    since the first student message it answers, and is empty for student messages.
+    """
+    for user in users:
+        for q in user.all_questions():
+            # The exercise may have been removed from the catalogue since
+            exercise = exercises[q.exo].name if q.exo < len(exercises) else f"#{q.exo}"
+            unanswered = None
+            for m in q.messages:
+                latency = None
+                if m.user in TEACHER_NAMES:
+                    role = "teacher" if m.user == TEACHER_NAME else "llm"
+                    if unanswered is not None:
+                        latency = round(m.timestamp - unanswered, 1)
+                    unanswered = None
+                else:
+                    role = "student"
+                    if m.skipped_by_teacher:
+                        unanswered = None
+                    elif unanswered is None:
+                        unanswered = m.timestamp
+                yield [
+                    user.name,
+                    exercise,
+                    q.variation,
+                    q.uid,
+                    m.user,
+                    role,
+                    m.timestamp,
+                    latency,
+                    int(m.skipped_by_teacher),
+                    m.content,
+                ]
+
+
+def write_transcripts(
+    databases: Iterable["DataBase"], exercises: list[Exercise], out: TextIO
+) -> int:
+    """
+    Write the messages of all the databases as CSV, each message once, and return the row count.
+
+    Databases are read one at a time, e.g. from Journal.states(), so memory stays bounded by the
+    largest one. A message in several of them is written the first time it is seen.
+    """
+    writer = csv.writer(out)
+    writer.writerow(TRANSCRIPT_COLUMNS)
+    # (question, author, timestamp) of the messages written
+    seen: set[tuple[str, str, float]] = set()
+    for database in databases:
+        for row in transcript_rows(database.users.values(), exercises):
+            key = (row[3], row[4], row[6])
+            if key not in seen:
+                seen.add(key)
+                writer.writerow(row)
+    return len(seen)
+
+
+@dataclass
+class Workshop:
+    database: DataBase
+    drafts: "FeedbackDrafts | None" = None
+    """Created by the first teacher session, see feedback_drafts()"""
+    last_used: float = field(default_factory=time)
+
+
+class Workshops:
+    """
+    The workshops open in this process, each with its own database, exercises and backups.
+
+    A workshop is loaded on first access and unloaded after `idle` seconds without any access.
+    Live sessions access their workshop every second, so it stays loaded while anyone is on it,
+    and memory and syncing cost only as much as the workshops in progress.
+    """
+
+    def __init__(self, idle: float = WORKSHOP_IDLE):
+        self.idle = idle
+        # Resolved once loaded. Loading is done outside of the lock, so that a workshop that
+        # takes long to load only blocks the sessions that wait for it.
+        self._loaded: dict[str, Future[Workshop]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str, load: Callable[[], DataBase]) -> Workshop:
+        now = time()
+        with self._lock:
+            unloaded = self._unload_idle(now)
+            future = self._loaded.get(name)
+            loading = future is None
+            if loading:
+                future = self._loaded[name] = Future()
+
+        for workshop in unloaded:
+            if workshop.database.storage is not None:
+                workshop.database.storage.close()
+
+        if loading:
+            try:
+                future.set_result(Workshop(load()))
+            except BaseException as e:
+                with self._lock:
+                    del self._loaded[name]  # The next access tries again
+                future.set_exception(e)
+                raise
+        workshop = future.result()
+        workshop.last_used = now
+        return workshop
+
+    def _unload_idle(self, now: float) -> list[Workshop]:
+        unloaded = []
+        for name, future in list(self._loaded.items()):
+            if not future.done() or future.exception() is not None:
+                continue
+            workshop = future.result()
+            if now - workshop.last_used < self.idle:
+                continue
+            # Drafts in progress keep the old database through on_ready, and the next load would
+            # request them again. They are done within LLM_TIMEOUT and its retries, wait for them.
+            if workshop.drafts is not None and workshop.drafts.pending():
+                continue
+            print(f"Unloading the idle workshop {name!r}")
+            del self._loaded[name]
+            unloaded.append(workshop)
+        return unloaded
+
+    def __len__(self) -> int:
+        return len(self._loaded)
 
 
 @st.cache_resource
-def db() -> DataBase:
+def metrics() -> Metrics:
+    m = Metrics()
+    if METRICS_PATH:
+        threading.Thread(
+            target=m.flush_forever, args=(Path(METRICS_PATH),), name="metrics", daemon=True
+        ).start()
+    return m
 
-    # Find latest backup
-    try:
-        file = max(BACKUP_DIR.iterdir(), key=lambda f: int(f.stem))
-    except ValueError:
-        return DataBase()
 
-    print(f"Loading backup from {file}")
+def load_database(files: WorkshopFiles, exercises: list[Exercise]) -> DataBase:
+    files.backups.mkdir(exist_ok=True)
     try:
-        return DataBase().reload(file)
+        storage = (
+            SqliteStorage(files.sqlite, files.backups) if files.sqlite else Journal(files.backups)
+        )
+        with metrics().time("load"):
+            database = storage.load()
     except Exception as e:
         print("🔥🔥🔥🔥🔥🔥🔥🔥🔥")
         print(e)
         traceback.print_exc()
-        return DataBase()
+        # Start from scratch, but never next to what we failed to load: the next start would load
+        # the empty database instead, and the retention could delete the real backups.
+        fallback = files.backups.with_name(f"{files.backups.name}-fallback-{int(time())}")
+        fallback.mkdir(parents=True)
+        print(f"Starting from an empty database, saved in {fallback}")
+        database = DataBase()
+        journal = Journal(fallback)
+        journal.snapshot(database)
+        database.storage = journal
+    database.metrics = metrics()
+    database.exercises = exercises
+    return database
 
 
-@st.cache_data()
-def get_llm_feedback(original: str, submission: str, exo: Exercise, model: str) -> str | None:
+@st.cache_resource
+def workshops() -> Workshops:
+    loaded = Workshops()
+    metrics().sources.append(lambda: dict(workshops_loaded=len(loaded)))
+    return loaded
 
-    def fmt(orig: str, sub: str):
-        return f"Original: {orig}\nResponse: {sub}"
 
-    examples: list[ChatCompletionMessageParam] = []
-    for example in exo.examples:
-        examples.append({"role": "user", "content": fmt(example.original, example.feedback)})
-        examples.append({"role": "assistant", "content": example.feedback})
+def workshop() -> Workshop:
+    """The workshop of the current session, loaded if needed."""
+    assert FILES is not None
+    current = workshops().get(WORKSHOP, lambda: load_database(FILES, EXERCISES))
+    # The workshop outlives the exercises, which are parsed again when their file changes
+    current.database.exercises = EXERCISES
+    if current.drafts is not None:
+        current.drafts.exercises = EXERCISES
+    return current
 
-    try:
-        response = openai.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": exo.system_prompt},
-                *examples,
-                {"role": "user", "content": fmt(original, submission)},
-            ],
+
+def db() -> DataBase:
+    return workshop().database
+
+
+def feedback_prompt(
+    original: str, submission: str, exo: Exercise
+) -> list["ChatCompletionMessageParam"]:
+    # Only the last message changes between calls
+    return [*exo.prompt_prefix, {"role": "user", "content": fmt_submission(original, submission)}]
+
+
+def batch_feedback_prompt(
+    original: str, submissions: list[str], exo: Exercise
+) -> list["ChatCompletionMessageParam"]:
+    responses = "\n".join(f"[{i + 1}] {submission}" for i, submission in enumerate(submissions))
+    content = (
+        f"{len(submissions)} participants answered the same original. Give each of them the"
+        " feedback you would give to a single response. Answer with a JSON object"
+        ' {"feedback": [...]} with one string per response, in the same order.\n\n'
+        f"Original: {original}\nResponses:\n{responses}"
+    )
+    # Same prefix as single requests, so that the provider can reuse its cache
+    return [*exo.prompt_prefix, {"role": "user", "content": content}]
+
+
+class TokenBucket:
+    """Allow `per_minute` units per minute, in bursts of up to as many units."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time()
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` units are available."""
+        now = time()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+
+@dataclass
+class LLMJob:
+    user: str
+    key: str | None
+    fn: Callable[[], Any]
+    tokens: int
+    future: Future
+    queued_at: float = field(default_factory=time)
+
+
+class LLMScheduler:
+    """
+    Process-wide queue for every call to the OpenAI API.
+
+    The rate limits only count the calls of this process: other workers have their own share.
+
+    Calls are started in turns between users, within the request and token rate limits and with
+    at most LLM_CONCURRENCY running at once. Identical calls in flight are coalesced, and rate
+    limits or transient errors are retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        client: "openai.OpenAI",
+        requests_per_minute: float = LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = LLM_TOKENS_PER_MINUTE,
+        concurrency: int = LLM_CONCURRENCY,
+        metrics: Metrics | None = None,
+    ):
+        import openai
+
+        self.client = client
+        self.metrics = metrics or Metrics()
+        self.retryable = (
+            openai.RateLimitError,
+            openai.APITimeoutError,
+            openai.APIConnectionError,
+            openai.InternalServerError,
         )
-    except Exception as e:
-        with st.expander("Silenced error"):
-            st.write(e)
-            st.exception(e)
-        return ""
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = concurrency
+
+        self._cond = threading.Condition()
+        self._queues: dict[str, deque[LLMJob]] = {}
+        self._turns: deque[str] = deque()  # Users with queued jobs, the next one to serve first
+        self._inflight: dict[str, Future] = {}
+        self._running = 0
+        self._paused_until = 0.0
+        self._pool = ThreadPoolExecutor(concurrency, thread_name_prefix="llm")
+
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.latencies: deque[tuple[float, float]] = deque(maxlen=200)  # (queued, total) seconds
+
+        threading.Thread(target=self._dispatch, name="llm-scheduler", daemon=True).start()
+
+    def submit(self, user: str, key: str | None, fn: Callable[[], T], tokens: int) -> Future[T]:
+        """Queue a call to the API on behalf of the user. Calls with the same key are coalesced."""
+        with self._cond:
+            if key is not None and (future := self._inflight.get(key)) is not None:
+                return future
+            job = LLMJob(user, key, fn, tokens, Future())
+            if key is not None:
+                self._inflight[key] = job.future
+            if user not in self._queues:
+                self._queues[user] = deque()
+                self._turns.append(user)
+            self._queues[user].append(job)
+            self._cond.notify_all()
+        return job.future
+
+    def _dispatch(self) -> None:
+        with self._cond:
+            while True:
+                if not self._turns or self._running >= self.concurrency:
+                    self._cond.wait()
+                    continue
+
+                job = self._queues[self._turns[0]][0]
+                delay = max(
+                    self._paused_until - time(),
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(job.tokens),
+                )
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                user = self._turns.popleft()
+                self._queues[user].popleft()
+                if self._queues[user]:
+                    self._turns.append(user)
+                else:
+                    del self._queues[user]
+                self.requests.take(1)
+                self.tokens.take(job.tokens)
+                self._running += 1
+                self._pool.submit(self._run, job)
+
+    def _run(self, job: LLMJob) -> None:
+        started = time()
+        result = error = None
+        for attempt in range(LLM_RETRIES + 1):
+            try:
+                result = job.fn()
+                error = None
+                break
+            except self.retryable as e:
+                error = e
+                if attempt == LLM_RETRIES:
+                    break
+                backoff = LLM_BACKOFF * 2**attempt * random.uniform(1, 1.5)
+                with self._cond:
+                    # Other calls would most likely hit the same rate limit
+                    self.retries += 1
+                    self._paused_until = max(self._paused_until, time() + backoff)
+                sleep(backoff)
+            except Exception as e:
+                error = e
+                break
+
+        with self._cond:
+            self._running -= 1
+            if job.key is not None:
+                self._inflight.pop(job.key, None)
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.latencies.append((started - job.queued_at, time() - job.queued_at))
+            self._cond.notify_all()
+        self.metrics.observe("llm_wait", started - job.queued_at)
+        self.metrics.observe("llm_request", time() - started)
+
+        if error is None:
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(error)
+
+    def stats(self) -> dict[str, float]:
+        with self._cond:
+            n = len(self.latencies) or 1
+            return dict(
+                queued=sum(len(q) for q in self._queues.values()),
+                running=self._running,
+                completed=self.completed,
+                failed=self.failed,
+                retries=self.retries,
+                mean_wait=sum(queued for queued, _ in self.latencies) / n,
+                mean_latency=sum(total for _, total in self.latencies) / n,
+            )
+
+
+@st.cache_resource
+def llm_scheduler() -> LLMScheduler:
+    # Configured by OPENAI_API_KEY and OPENAI_BASE_URL, which can point to fake_openai.py
+    # Retries are handled by the scheduler.
+    import openai  # Only now, it is the slowest import and students may never need it
+
+    scheduler = LLMScheduler(openai.OpenAI(timeout=LLM_TIMEOUT, max_retries=0), metrics=metrics())
+    metrics().sources.append(lambda: {f"llm_{k}": v for k, v in scheduler.stats().items()})
+    return scheduler
+
+
+def record_usage(metrics: Metrics, model: str, usage: Any) -> None:
+    """Count the tokens of an API call and what they cost."""
+    if usage is None:
+        return
+    details = usage.prompt_tokens_details
+    cached = (details.cached_tokens or 0) if details is not None else 0
+    metrics.count("llm_prompt_tokens", usage.prompt_tokens, model=model)
+    metrics.count("llm_cached_prompt_tokens", cached, model=model)
+    metrics.count("llm_completion_tokens", usage.completion_tokens, model=model)
+    if model in LLM_PRICES:
+        input_price, cached_price, output_price = LLM_PRICES[model]
+        cost = (
+            (usage.prompt_tokens - cached) * input_price
+            + cached * cached_price
+            + usage.completion_tokens * output_price
+        ) / 1e6
+        metrics.count("llm_cost_usd", cost, model=model)
+
+
+def estimate_tokens(messages: list["ChatCompletionMessageParam"]) -> int:
+    # About 4 characters per token, plus the answer
+    return sum(len(str(m.get("content", ""))) for m in messages) // 4 + LLM_COMPLETION_TOKENS
+
+
+class FeedbackCache:
+    """
+    LLM feedback stored in SQLite, so that it survives restarts and is shared between processes.
+
+    Entries expire after `ttl` seconds, and the least recently used ones are evicted when there
+    are more than `max_entries`.
+    """
+
+    def __init__(self, path: Path, max_entries: int = LLM_CACHE_SIZE, ttl: float = LLM_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS feedback"
+            " (key TEXT PRIMARY KEY, feedback TEXT NOT NULL, created REAL, used REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS feedback_used ON feedback (used)")
+
+    @staticmethod
+    def key(exo: Exercise, original: str, submission: str, model: str) -> str:
+        # Answers that differ only by case or spacing get the same feedback
+        normalized = " ".join(submission.split()).casefold()
+        return hashlib.sha256(
+            json.dumps([exo.name, exo.prompt_hash, original, normalized, model]).encode()
+        ).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT feedback FROM feedback WHERE key = ? AND created > ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE feedback SET used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, key: str, feedback: str) -> None:
+        now = time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO feedback VALUES (?, ?, ?, ?)", (key, feedback, now, now)
+            )
+            self._conn.execute("DELETE FROM feedback WHERE created <= ?", (now - self.ttl,))
+            self._conn.execute(
+                "DELETE FROM feedback WHERE key IN"
+                " (SELECT key FROM feedback ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM feedback").fetchone()[0]
+
+
+@st.cache_resource
+def feedback_cache() -> FeedbackCache:
+    cache = FeedbackCache(LLM_CACHE_PATH)
+    metrics().sources.append(lambda: dict(llm_cache_hits=cache.hits, llm_cache_misses=cache.misses))
+    return cache
+
+
+def llm_feedback(
+    scheduler: LLMScheduler,
+    user: str,
+    original: str,
+    submission: str,
+    exo: Exercise,
+    model: str,
+    cache: FeedbackCache | None = None,
+) -> Future[str]:
+    """Ask the model for feedback on a submission, unless it is cached."""
+
+    key = FeedbackCache.key(exo, original, submission, model)
+    if cache is not None and (feedback := cache.get(key)) is not None:
+        done: Future[str] = Future()
+        done.set_result(feedback)
+        return done
+
+    messages = feedback_prompt(original, submission, exo)
+
+    def complete() -> str:
+        response = scheduler.client.chat.completions.create(model=model, messages=messages)
+        record_usage(scheduler.metrics, model, response.usage)
+        feedback = response.choices[0].message.content or ""
+        if cache is not None and feedback:
+            cache.put(key, feedback)
+        return feedback
+
+    return scheduler.submit(user, key, complete, estimate_tokens(messages))
+
+
+def llm_batch_feedback(
+    scheduler: LLMScheduler,
+    user: str,
+    original: str,
+    submissions: list[str],
+    exo: Exercise,
+    model: str,
+    cache: FeedbackCache | None = None,
+) -> Future[list[str]]:
+    """Ask for feedback on several submissions to the same original, in a single request.
+
+    The feedback is cached per submission, as if it was asked with llm_feedback.
+    """
+
+    messages = batch_feedback_prompt(original, submissions, exo)
+
+    def complete() -> list[str]:
+        response = scheduler.client.chat.completions.create(
+            model=model, messages=messages, response_format={"type": "json_object"}
+        )
+        record_usage(scheduler.metrics, model, response.usage)
+        feedback = json.loads(response.choices[0].message.content or "{}").get("feedback")
+        if not isinstance(feedback, list) or len(feedback) != len(submissions):
+            raise ValueError(f"Expected {len(submissions)} feedbacks, got {feedback!r}")
+        feedback = [str(f) for f in feedback]
+        if cache is not None:
+            for submission, f in zip(submissions, feedback):
+                cache.put(FeedbackCache.key(exo, original, submission, model), f)
+        return feedback
+
+    tokens = estimate_tokens(messages) + LLM_COMPLETION_TOKENS * (len(submissions) - 1)
+    return scheduler.submit(user, None, complete, tokens)
+
+
+def stream_llm_feedback(
+    scheduler: LLMScheduler,
+    user: str,
+    original: str,
+    submission: str,
+    exo: Exercise,
+    model: str,
+    cache: FeedbackCache | None = None,
+) -> Iterator[str]:
+    """Like llm_feedback, but yield the feedback as it is generated."""
+
+    key = FeedbackCache.key(exo, original, submission, model)
+    if cache is not None and (feedback := cache.get(key)) is not None:
+        yield feedback
+        return
+
+    messages = feedback_prompt(original, submission, exo)
+    # Wait for our turn to start the request, then read it without blocking the queue
+    stream = scheduler.submit(
+        user,
+        None,
+        lambda: scheduler.client.chat.completions.create(
+            model=model, messages=messages, stream=True, stream_options={"include_usage": True}
+        ),
+        estimate_tokens(messages),
+    ).result()
+
+    parts = []
+    for chunk in stream:
+        if chunk.choices and (delta := chunk.choices[0].delta.content):
+            parts.append(delta)
+            yield delta
+        # The usage comes in a last chunk, without choices
+        record_usage(scheduler.metrics, model, chunk.usage)
+
+    if cache is not None and parts:
+        cache.put(key, "".join(parts))
+
+
+def show_silenced_error(e: BaseException) -> None:
+    with st.expander("Silenced error"):
+        st.write(e)
+        st.exception(e)
+
+
+class FeedbackDrafts:
+    """
+    Generate LLM feedback in the background, so that it is ready when the teacher needs it.
+
+    Drafts are started as soon as a question receives its first message, and are generated
+    through the LLMScheduler. With a batch window, first messages on the same variation are
+    collected for that long and drafted in one request, which repeats the prompt only once.
+    """
+
+    def __init__(
+        self,
+        scheduler: LLMScheduler,
+        cache: FeedbackCache,
+        exercises: list[Exercise],
+        on_ready: Callable[[], None],
+    ):
+        # The model selected by the teacher, None to disable drafts
+        self.model: str | None = MODELS[0]
+        # Seconds to collect similar submissions before drafting them together, 0 to disable
+        self.batch_window: float = 0
+        self.scheduler = scheduler
+        self.cache = cache
+        self.exercises = exercises
+        self.on_ready = on_ready
+        # Cache key -> draft, least recently requested first
+        self._drafts: OrderedDict[str, Future[str]] = OrderedDict()
+        # (exercise, original, model) -> submissions waiting for the batch, with their user
+        self._batches: dict[tuple[str, str, str], list[tuple[str, str, Future[str]]]] = {}
+        self._lock = threading.Lock()
+
+    def request(self, question: Question, model: str | None = None) -> Future[str] | None:
+        """Start drafting feedback on the first message of the question, if not already done."""
+        model = model or self.model
+        if not model or not question.messages:
+            return None
+
+        exo = self.exercises[question.exo]
+        original = question.variation_text(self.exercises)
+        submission = question.messages[0].content
+        key = FeedbackCache.key(exo, original, submission, model)
+        with self._lock:
+            future = self._drafts.get(key)
+            if future is None:
+                if self.batch_window > 0 and (cached := self.cache.get(key)) is None:
+                    future = self._add_to_batch(question.user, exo, original, submission, model)
+                elif self.batch_window > 0:
+                    future = Future()
+                    future.set_result(cached)
+                else:
+                    future = llm_feedback(
+                        self.scheduler, question.user, original, submission, exo, model, self.cache
+                    )
+                future.add_done_callback(lambda _: self.on_ready())
+                self._drafts[key] = future
+                self._evict()
+            else:
+                self._drafts.move_to_end(key)
+        return future
+
+    def pending(self) -> bool:
+        """Whether some drafts are not done yet."""
+        with self._lock:
+            return any(not future.done() for future in self._drafts.values())
+
+    def _evict(self) -> None:
+        # The oldest drafts are done, a pending one would only be requested again
+        while len(self._drafts) > LLM_DRAFTS_SIZE and next(iter(self._drafts.values())).done():
+            self._drafts.popitem(last=False)
+
+    def _add_to_batch(
+        self, user: str, exo: Exercise, original: str, submission: str, model: str
+    ) -> Future[str]:
+        group = (exo.name, original, model)
+        batch = self._batches.get(group)
+        if batch is None:
+            batch = self._batches[group] = []
+            timer = threading.Timer(self.batch_window, self._send, args=(exo, group, batch))
+            timer.daemon = True
+            timer.start()
+
+        future: Future[str] = Future()
+        batch.append((user, submission, future))
+        if len(batch) >= LLM_BATCH_SIZE:
+            # Sent right away in another thread, the timer will find the batch gone
+            threading.Thread(target=self._send, args=(exo, group, batch), daemon=True).start()
+        return future
+
+    def _send(self, exo: Exercise, group: tuple[str, str, str], batch: list) -> None:
+        with self._lock:
+            if self._batches.get(group) is not batch:
+                return  # Already sent
+            del self._batches[group]
+
+        _, original, model = group
+        submissions = [submission for _, submission, _ in batch]
+        result = llm_batch_feedback(
+            self.scheduler, TEACHER_NAME, original, submissions, exo, model, self.cache
+        )
+
+        def split(result: Future[list[str]]) -> None:
+            if result.exception() is None:
+                for (_, _, future), feedback in zip(batch, result.result()):
+                    future.set_result(feedback)
+                return
+            # Fall back to one request per submission
+            for user, submission, future in batch:
+                single = llm_feedback(
+                    self.scheduler, user, original, submission, exo, model, self.cache
+                )
+                single.add_done_callback(lambda single, future=future: copy_future(single, future))
+
+        result.add_done_callback(split)
+
+
+def copy_future(source: Future, target: Future) -> None:
+    if source.exception() is None:
+        target.set_result(source.result())
+    else:
+        target.set_exception(source.exception())
+
+
+def feedback_drafts() -> FeedbackDrafts:
+    """The drafts of the current workshop, which share the LLM rate limits and cache."""
+    current = workshop()
+    if current.drafts is None:
+        current.drafts = FeedbackDrafts(
+            llm_scheduler(), feedback_cache(), EXERCISES, on_ready=current.database.notify
+        )
+    return current.drafts
+
 
-    return response.choices[0].message.content
+@st.cache_resource(max_entries=4)
+def parse_database(digest: str, _data: bytes) -> DataBase:
+    """An uploaded database, parsed once per content. Read-only, it is shared by all sessions."""
+    return DataBase.from_json(json.loads(_data))
+
+
+@st.cache_resource(max_entries=4)
+def load_backup(path: str) -> DataBase:
+    """An older snapshot with its log replayed, loaded once since its log is complete. Read-only."""
+    return Journal(Path(path).parent).replay(Path(path))
 
 
 def admin_panel():
+    started = perf_counter()
 
     db().__class__ = DataBase  # Hack to have the new methods available during development
 
@@ -334,6 +2287,29 @@ def admin_panel():
         st.metric("Mean answer time", f"{answer_time:.0f} seconds")
 
         model = st.selectbox("OpenAI model", MODELS)
+        # Only created once a model is selected, the app works without OpenAI otherwise
+        drafts = workshop().drafts
+        if model and drafts is None:
+            try:
+                drafts = feedback_drafts()
+            except Exception as e:
+                # E.g. no API key
+                show_silenced_error(e)
+        if drafts is not None:
+            drafts.model = model
+            batch = st.toggle(
+                "Batch similar submissions",
+                help=f"Wait {LLM_BATCH_WINDOW}s for more answers to the same variation, and draft"
+                " their feedback in one request.",
+            )
+            drafts.batch_window = LLM_BATCH_WINDOW if batch else 0
+            cache = drafts.cache
+            st.caption(f"LLM cache: {cache.hits} hits, {cache.misses} misses, {len(cache)} entries")
+            llm_stats = drafts.scheduler.stats()
+            st.caption(
+                f"LLM queue: {llm_stats['queued']} waiting, {llm_stats['running']} running, "
+                f"{llm_stats['mean_latency']:.1f}s mean latency, {llm_stats['retries']} retries"
+            )
 
         txt = "## Participants\n"
         if db().users:
@@ -345,37 +2321,69 @@ def admin_panel():
 
         # Histogram of answer times
 
-        times = db().answer_times()
-        if times:
-            df = pd.DataFrame({"time": times})
-            hist = (
-                alt.Chart(df)
-                .mark_bar()
-                .encode(
-                    x=alt.X("time", bin=alt.Bin(maxbins=20), title="Time to answer (s)"),
-                    y="count()",
-                )
+        stats = db().answer_time_stats
+        if len(stats):
+            st.write(
+                f"Median {stats.percentile(50):.0f}s, 90th percentile {stats.percentile(90):.0f}s"
             )
-            st.altair_chart(hist, use_container_width=True)
+            # A plain vega-lite spec over the bins, without importing altair and pandas
+            hist = {
+                "data": {
+                    "values": [
+                        {"start": start, "end": end, "count": count}
+                        for start, end, count in stats.bins()
+                    ]
+                },
+                "mark": "bar",
+                "encoding": {
+                    "x": {
+                        "field": "start",
+                        "bin": "binned",
+                        "type": "quantitative",
+                        "title": "Time to answer (s)",
+                    },
+                    "x2": {"field": "end"},
+                    "y": {"field": "count", "type": "quantitative"},
+                },
+            }
+            st.vega_lite_chart(hist, use_container_width=True)
 
         with st.expander("⚙ Database"):
-            st.button("Wipe database", on_click=lambda: db().users.clear())
-            st.download_button(
-                "Download current database",
-                json.dumps(db().to_json(), indent=2),
-                "database.json",
-                "Download the database as a JSON file",
-            )
-            backups = sorted(BACKUP_DIR.iterdir(), reverse=True)
+            st.button("Wipe database", on_click=lambda: db().replace_users({}))
+            # Only on demand, the whole database is converted for each
+            export_key = f"export-{WORKSHOP}"
+            if st.button("Prepare export", help="The database as JSON, and its transcripts"):
+                with metrics().time("export_json"):
+                    data = json.dumps(db().to_json(), indent=2)
+                with metrics().time("export_csv"):
+                    transcripts = io.StringIO()
+                    write_transcripts([db()], EXERCISES, transcripts)
+                st.session_state[export_key] = (time(), data, transcripts.getvalue())
+            if export_key in st.session_state:
+                prepared, data, transcripts = st.session_state[export_key]
+                st.caption(f"Prepared at {datetime.fromtimestamp(prepared):%H:%M:%S}")
+                st.download_button(
+                    "Download current database",
+                    data,
+                    f"{WORKSHOP or 'database'}.json",
+                    "Download the database as a JSON file",
+                )
+                st.download_button(
+                    "Download transcripts",
+                    transcripts,
+                    f"{WORKSHOP or 'workshop'}-transcripts.csv",
+                    "text/csv",
+                    help="One row per message, for analysis. `python export.py` exports backups.",
+                )
+            backups = Journal(FILES.backups).backups()
             if backups:
                 labeled_backups = {
-                    # file: datetime.fromtimestamp(int(file.stem)).strftime("%Y-%m-%d %H:%M:%S")
+                    # datetime.fromtimestamp(b.timestamp).strftime("%Y-%m-%d %H:%M:%S"): b
                     # Tue 1st Jan 2030 00:00:00
-                    file: datetime.fromtimestamp(int(file.stem)).strftime("%a %d %b %Y %H:%M:%S")
-                    for file in backups
+                    datetime.fromtimestamp(b.timestamp).strftime("%a %d %b %Y %H:%M:%S"): b
+                    for b in backups
                 }
-                label = st.selectbox("Backup to load", list(labeled_backups.values()))
-                file = next(file for file, date in labeled_backups.items() if date == label)
+                label = st.selectbox("Backup to load", list(labeled_backups))
 
             else:
                 label = None
@@ -386,23 +2394,69 @@ def admin_panel():
                 label = "uploaded file"
 
             if label is not None:
-                # Load a copy of the database
                 if label == "uploaded file":
-                    new_db = DataBase.from_json(json.loads(new.read().decode()))
+                    data = new.getvalue()
+                    selected = hashlib.sha256(data).hexdigest()
                 else:
-                    new_db = DataBase().reload(file)
+                    backup = labeled_backups[label]
+                    selected = backup.path.name
+                    if backup.progress is not None:
+                        # From the manifest, so without the changes in the log of the snapshot
+                        progress = ", ".join(
+                            f"**{u}** ({done}/{NUM_QUESTIONS})"
+                            for u, done in backup.progress.items()
+                        )
+                        st.caption(f"When the snapshot was taken: {progress or 'empty'}")
+
+                # Loading takes seconds, so only when asked. The session keeps it until another
+                # backup is selected.
+                inspected_key = f"inspected-{WORKSHOP}"
+                if st.button("Inspect backup", help="Load it, and see what merging it adds"):
+                    if label == "uploaded file":
+                        loaded = parse_database(selected, data)
+                    elif backup is backups[0]:
+                        # Its log may still be appended to, so it is loaded as it is now
+                        loaded = Journal(FILES.backups).replay(backup.path)
+                    else:
+                        loaded = load_backup(str(backup.path))
+                    st.session_state[inspected_key] = selected, loaded
+                inspected, new_db = st.session_state.get(inspected_key, (None, None))
+            else:
+                inspected = None
+
+            if inspected is not None and inspected == selected:
+                progress = new_db.progress()
+                diff = db().diff(new_db)
 
                 # Show info about the backup
                 st.write(
                     f"""
                 ### Backup info
-                {', '.join(f'**{u}** ({new_db.questions_done(u)}/{NUM_QUESTIONS})' for u in new_db.users) or 'empty'}
+                {', '.join(f'**{u}** ({done}/{NUM_QUESTIONS})' for u, done in progress.items()) or 'empty'}
+
+                Merging it adds {diff.summary()}.
                     """
                 )
 
-                if st.button(f"⚠ Load backup from {label}"):
-                    db().users.clear()
-                    db().users.update(new_db.users)
+                # Callbacks, so that the page shows the database after the change
+                st.button(
+                    f"Merge backup from {label}",
+                    type="primary",
+                    on_click=lambda: st.toast(f"Merged {db().merge(new_db).summary()}"),
+                )
+                st.button(
+                    f"⚠ Replace with backup from {label}",
+                    # Copies, the cached database must stay as it was parsed
+                    on_click=lambda: db().replace_users(DataBase.from_json(new_db.to_json()).users),
+                )
+
+        # Hidden unless the URL has ?metrics=1
+        if st.query_params.get("metrics"):
+            with st.expander("📈 Metrics", expanded=True):
+                st.markdown(metrics().summary())
+                st.download_button(
+                    "Download for Prometheus", metrics().to_prometheus(), "metrics.prom"
+                )
 
         # Update the source code code.
         # with st.expander("🛠 Source code"):
@@ -445,11 +2499,25 @@ def admin_panel():
 
     st.write("# Feedback panel")
 
-    questions_to_answer = db().questions_needing_feedback()
+    # Only the first questions are rendered, the teacher answers the oldest first anyway
+    with metrics().time("questions_needing_feedback"):
+        questions_to_answer = db().questions_needing_feedback(FEEDBACK_PAGE_SIZE)
+        waiting = db().num_needing_feedback()
     if not questions_to_answer:
         st.write("No questions needing feedback")
+    elif waiting > len(questions_to_answer):
+        st.caption(
+            f"{waiting} questions waiting, here are the {len(questions_to_answer)} oldest."
+            " The next ones show up as you answer."
+        )
+
+    # Questions already shown in this session. The form keeps what the teacher types until they
+    # send it, so the text area is only filled on the first render, before they could type.
+    rendered = st.session_state.setdefault("rendered_questions", set())
 
     for q in questions_to_answer:
+        first_render = q.uid not in rendered
+        rendered.add(q.uid)
         exo = EXERCISES[q.exo]
         variation = exo.variations[q.variation]
 
@@ -465,41 +2533,61 @@ def admin_panel():
                 st.write(exo.instructions)
                 st.divider()
 
-                # Collect last 5 questions with discussions
-                qs = sorted(
-                    [
-                        q_
-                        for q_ in db().users[q.user].all_questions()
-                        if q_.messages and q_ is not q
-                    ],
-                    key=lambda q: q.last_message_time,
-                    reverse=True,
-                )[:5]
+                qs = db().recent_chats(q)
 
                 if qs:
                     st.write("#### Previous chats")
                     for q_ in qs:
-                        st.write(f"On **{q_.full_exo.name}** — {q_.variation_text}")
+                        st.write(
+                            f"On **{EXERCISES[q_.exo].name}** — {q_.variation_text(EXERCISES)}"
+                        )
                         st.write(q_.fmt_messages(TEACHER_NAME))
                 else:
                     st.write("No previous chats")
 
             st.write(q.fmt_messages(TEACHER_NAME))
 
-            if q.never_got_feedback and model:
-                default = get_llm_feedback(
-                    variation, q.messages[0].content, EXERCISES[q.exo], model
-                )
-            elif q.never_got_feedback:
-                default = ""
-            else:
-                default = ""
+            suggestions = db().similar_feedback(q) if q.never_got_feedback else []
+            reused = db().near_duplicate_feedback(q) if q.never_got_feedback else None
+            if reused is not None and first_render and not st.session_state.get(q.uid):
+                # Almost the same as a previous submission, reuse its feedback
+                st.session_state[q.uid] = reused
+
+            # No need to ask the LLM when a near duplicate already has feedback
+            if q.never_got_feedback and model and drafts is not None and reused is None:
+                draft = drafts.request(q, model)
+                if draft is None or not draft.done():
+                    st.caption(f"⏳ Drafting feedback with {model}...")
+                elif draft.exception() is not None:
+                    show_silenced_error(draft.exception())
+                elif first_render and not st.session_state.get(q.uid):
+                    st.session_state[q.uid] = draft.result()
+                else:
+                    with st.expander(f"🤖 Draft from {model}"):
+                        st.write(draft.result())
+                        st.button(
+                            "Use draft",
+                            key=f"use-draft-{q.uid}",
+                            on_click=st.session_state.__setitem__,
+                            args=(q.uid, draft.result()),
+                        )
+
+            for i, (similarity, submission, feedback) in enumerate(suggestions):
+                short = submission if len(submission) < 80 else submission[:80] + "…"
+                with st.expander(f"💡 {similarity:.0%} similar: {short}"):
+                    st.write(feedback)
+                    st.button(
+                        "Use this feedback",
+                        key=f"use-{i}-{q.uid}",
+                        on_click=st.session_state.__setitem__,
+                        args=(q.uid, feedback),
+                    )
 
             with st.form(key=f"form-{q.uid}"):
-                new_msg = st.text_area("Feedback", value=default, height=250, key=q.uid)
+                new_msg = st.text_area("Feedback", height=250, key=q.uid)
                 submit = st.form_submit_button("Send")
             if new_msg and submit:
-                q.messages.append(Message(TEACHER_NAME, new_msg))
+                db().add_message(q, Message(TEACHER_NAME, new_msg))
                 cont.empty()
                 st.rerun()
 
@@ -508,21 +2596,99 @@ def admin_panel():
             if not q.never_got_feedback:
                 skip = st.button("Skip", key="skip" + q.uid)
                 if skip:
-                    q.messages[-1].skipped_by_teacher = True
+                    db().skip(q)
                     cont.empty()
                     st.rerun()
 
-    # Check for new questions every second
-    old_db = deepcopy(db())
-    while True:
-        if old_db != db():
-            # Backup the database every new message
-            db().save(BACKUP_DIR / f"{int(time())}.json")
+    # Wait for new questions. Streamlit can only stop the script for a rerun (e.g. when the
+    # teacher clicks Send) when it writes to the page, so we clear a placeholder on each timeout.
+    metrics().observe("render_admin", perf_counter() - started)
+    idle = st.empty()
+    seen = db().revision
+    while LIVE_UPDATES:
+        if db().wait_for_change([db()], [seen], timeout=1):
             st.rerun()
-        sleep(0.5)
+        idle.empty()
+
+
+def current_exercise(user: User) -> int:
+    """Index of the first exercise with a question that never got feedback."""
+    for e, qs in enumerate(user.exos):
+        if any(q.never_got_feedback for q in qs):
+            return e
+    return len(user.exos)
+
+
+def rerun_fragment():
+    """Rerun only the fragment being run, or the whole page during a full run."""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        # Streamlit refuses fragment reruns outside of fragment reruns
+        st.rerun()
+
+
+def show_exercise(username: str, e: int, automatic_mode: bool, refresh: Callable[[], None]):
+    """Show the instructions and the unlocked variations of an exercise.
+
+    `refresh` is called to show the new messages after the user sends one.
+    """
+    exo = EXERCISES[e]
+    st.write(exo.instructions, unsafe_allow_html=True)
+
+    for i, (q, variation) in enumerate(zip(db().users[username].exos[e], exo.variations)):
+        st.markdown(f"### Variation {i+1}\n{variation}")
+
+        with st.container():
+            st.write(q.fmt_messages(username))
+            if len(q.messages) != 1 and (new := st.chat_input(key=f"chat-{q.uid}")):
+                msg = Message(username, new)
+                db().add_message(q, msg)
+                # If the user is in automatic mode, we directly use gpt for feedback
+                if automatic_mode:
+                    st.write(f"**Me**: {new}  \n**{LLM_NAME}**:")
+                    answer = ""
+                    try:
+                        # Show the feedback as it arrives, but save it only once complete
+                        answer = st.write_stream(
+                            stream_llm_feedback(
+                                llm_scheduler(),
+                                username,
+                                variation,
+                                msg.content,
+                                exo,
+                                AUTOMATIC_MODE_MODEL,
+                                feedback_cache(),
+                            )
+                        )
+                    except Exception as e:
+                        show_silenced_error(e)
+                    if str(answer).strip():
+                        db().add_message(q, Message(LLM_NAME, str(answer)))
+                    else:
+                        # No empty feedback: the answer stays in the teacher's queue instead
+                        st.toast(
+                            f"The automatic feedback failed, {TEACHER_NAME} will answer instead."
+                        )
+                elif (
+                    len(q.messages) == 1
+                    and (drafts := workshop().drafts) is not None
+                    and db().near_duplicate_feedback(q) is None
+                ):
+                    # Prepare the feedback before the teacher opens the question. Drafts exist
+                    # once a teacher selected a model.
+                    drafts.request(q)
+                refresh()
+
+        # If there was never any feedback, don't show the following questions
+        if username == "D":
+            continue
+        if q.never_got_feedback:
+            break
 
 
 def student_panel(username):
+    started = perf_counter()
     user = db().users[username]
 
     automatic_mode = st.query_params.get("automatic_mode", False)
@@ -535,92 +2701,93 @@ def student_panel(username):
             f"You are in automatic mode. You will get feedback imediately from an LLM (here, {AUTOMATIC_MODE_MODEL})."
         )
 
-    for i, (exo, qs) in enumerate(zip(EXERCISES, user.exos)):
-        anchor = f"<a name='exo-{i+1}'></a>\n"
-        st.write(anchor + exo.instructions, unsafe_allow_html=True)
-
-        for i, (q, variation) in enumerate(zip(qs, exo.variations)):
-            st.markdown(f"### Variation {i+1}\n{variation}")
-
-            with st.container():
-                st.write(q.fmt_messages(username))
-                if len(q.messages) != 1 and (new := st.chat_input(key=f"chat-{q.uid}")):
-                    msg = Message(username, new)
-                    q.messages.append(msg)
-                    # If the user is in automatic mode, we directly use gpt for feedback
-                    if automatic_mode:
-                        answer = get_llm_feedback(variation, msg.content, exo, AUTOMATIC_MODE_MODEL)
-                        q.messages.append(Message(LLM_NAME, answer))
-                    st.rerun()
-
-            # If there was never any feedback, don't show the following questions
-            if username == "D":
-                continue
-            if q.never_got_feedback:
-                break
-        else:
-            st.divider()
-            continue
-        break
-
     with st.sidebar:
         st.write("*Table of contents*")
-        toc = ""
-        for i, (exo, qs) in enumerate(zip(EXERCISES, user.exos)):
-            # First line with a # is the title
-            header = next(
-                (line for line in exo.instructions.splitlines() if line.strip().startswith("#")),
-                "no header",
-            )
-            title = header.lstrip("# ")
-            depth = header[: -len(title)].count("#")
-            # if title != "no header":
-            if depth == 1:
-                toc += f"\n[{title}](#exo-{i+1})  "
-            elif depth == 2:
-                toc += f"- [{title}](#exo-{i+1})  "
-            toc += "\n"
-            # st.write(f"[{title}](#exo-{i+1})")
-            # if any(q.never_got_feedback for q in qs):
-            # break
-
-        st.markdown(toc)
-
-        st.metric("Progress", f"{db().questions_done(username)}/{NUM_QUESTIONS}")
-
-    with st.sidebar:
+        st.markdown(CATALOGUE.toc)
+        progress = st.empty()
         timer = st.empty()
-    last_snow = 0
 
-    # Check for new messages every second
-    past_msgs = deepcopy(user)
-    while True:
-        if past_msgs != user:
+    # Completed exercises are folded, so that they cost nothing until the user opens them
+    current = current_exercise(user)
+    unfolded = []
+    for e in range(current):
+        st.write(
+            f"<a name='exo-{e+1}'></a>\n\n### ✅ {CATALOGUE.titles[e]}", unsafe_allow_html=True
+        )
+        if st.toggle("Show the exercise and my answers", key=f"show-exo-{e}"):
+            show_exercise(username, e, automatic_mode, st.rerun)
+            unfolded.extend(user.exos[e])
+        st.divider()
+    unfolded_seen = [q.revision for q in unfolded]
+    # Only full reruns render the page outside of the fragment
+    outside = 0.0
+
+    def refresh():
+        # Unlocking the next exercise changes the rest of the page
+        if db().users.get(username) is user and current_exercise(user) == current:
+            rerun_fragment()
+        else:
             st.rerun()
-        sleep(0.5)
 
-        # Show the timer for the current question
-        done = [q for q in user.all_questions() if q.messages]
-        to_do = [q for q in user.all_questions() if not q.messages]
+    @st.fragment
+    def live_exercise():
+        """The current exercise, which is the only part of the page rerun on new messages."""
+        nonlocal outside
+        exercise_started = perf_counter()
+        shown = range(current, len(EXERCISES) if username == "D" else current + 1)
+        # Only the questions on the page matter, and their revisions before they are shown
+        watched = unfolded + [q for e in shown for q in user.exos[e]]
+        seen = unfolded_seen + [q.revision for q in watched[len(unfolded) :]]
+        for e in shown:
+            st.write(f"<a name='exo-{e+1}'></a>", unsafe_allow_html=True)
+            show_exercise(username, e, automatic_mode, refresh)
+            st.divider()
 
-        if not done or not to_do or to_do[0].full_exo.disable_timer:
-            continue
+        progress.metric("Progress", f"{db().questions_done(username)}/{NUM_QUESTIONS}")
+        rendered = perf_counter() - exercise_started
+        metrics().observe("render_exercise", rendered)
+        metrics().observe("render_student", outside + rendered)
+        outside = 0.0
+        last_snow = 0
+
+        # Wait for new messages, waking up every second to update the timer.
+        # Each wake-up writes to the page, which is where streamlit can stop us for a rerun.
+        while LIVE_UPDATES:
+            if db().wait_for_change(watched, seen, timeout=1):
+                if [q.revision for q in unfolded] != unfolded_seen:
+                    st.rerun()  # The unfolded exercises are outside of the fragment
+                refresh()
+            if db().users.get(username) is not user:
+                st.rerun()  # The database was wiped or a backup loaded
+
+            # Show the timer for the current question
+            to_do = db().current_question(username)
+            last_message_time = db().last_message_time(username)
+            if to_do is None or last_message_time is None or EXERCISES[to_do.exo].disable_timer:
+                timer.empty()
+                continue
 
-        time_since_last_msg = time() - done[-1].last_message_time
-        time_left_for_question = TIME_PER_QUESTION - time_since_last_msg
-        minutes, seconds = divmod(abs(time_left_for_question), 60)
-        if time_left_for_question >= 0:
-            timer.metric("Time left for the question", f"{minutes:02.0f}:{seconds:02.0f}")
-        else:
-            timer.metric("Time over since", f"{minutes:02.0f}:{seconds:02.0f}")
+            time_since_last_msg = time() - last_message_time
+            time_left_for_question = TIME_PER_QUESTION - time_since_last_msg
+            minutes, seconds = divmod(abs(time_left_for_question), 60)
+            if time_left_for_question >= 0:
+                timer.metric("Time left for the question", f"{minutes:02.0f}:{seconds:02.0f}")
+            else:
+                timer.metric("Time over since", f"{minutes:02.0f}:{seconds:02.0f}")
+
+                if time() - last_snow > 40:
+                    last_snow = time()
+                    st.snow()
+                    st.toast("Time's up, try to submit :)")
 
-            if time() - last_snow > 40:
-                last_snow = time()
-                st.snow()
-                st.toast("Time's up, try to submit :)")
+    outside = perf_counter() - started
+    live_exercise()
 
 
 def main():
+    # Logging in is per workshop, the session logs in again if the link changes
+    if st.session_state.get("workshop", WORKSHOP) != WORKSHOP:
+        st.session_state.pop("username", None)
     username = st.session_state.get("username")
 
     if username is None:
@@ -636,6 +2803,7 @@ def main():
         if submit:
             if db().login(username, password):
                 st.session_state.username = username
+                st.session_state.workshop = WORKSHOP
             else:
                 st.error("Wrong login/password, try again.")
                 sleep(1)